@@ -0,0 +1,98 @@
+'''
+HTTP API answering trip queries from memory, without a database round-trip.
+
+    uvicorn api:app --port 8000
+'''
+import traceback
+from contextlib import asynccontextmanager
+from datetime import date, time
+
+from fastapi import FastAPI, HTTPException
+
+from query import current_trip_index, load_trip_index
+from telemetry import start_metrics_server
+from utils import ArtifactMismatchError, get_published_parquet_files
+
+
+# Typed artifacts the index is built from
+INDEX_TABLES = ("stops.parquet", "bus_trips.parquet", "bus_schedule.parquet", "bus_timetable.parquet")
+
+
+def reload_from_store():
+    return load_trip_index(get_published_parquet_files(INDEX_TABLES))
+
+
+def try_reload_from_store() -> str:
+    '''
+    Reload the index, returning why it could not be when it failed. The previous
+    index, if any, keeps answering.
+    '''
+    try:
+        reload_from_store()
+    except FileNotFoundError as e:
+        return f"No bus schedule has been published yet: {e}"
+    except ArtifactMismatchError as e:
+        # A publish that stopped half way, the next complete one can be loaded
+        return f"The published bus schedule is incomplete: {e}"
+    except Exception as e:
+        # The store could not be reached
+        traceback.print_exc()
+        return f"The bus schedule could not be loaded: {e!r}"
+    return None
+
+
+def trip_index():
+    # Before the first workbook is published there is nothing to answer from
+    index = current_trip_index()
+    if index is None:
+        raise HTTPException(status_code=503, detail="No bus schedule has been published yet")
+    return index
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    start_metrics_server()
+    error = try_reload_from_store()
+    if error is not None:
+        # Queries answer 503 until a schedule is published and /reload is called
+        print(error)
+    yield
+
+
+app = FastAPI(title="Bus schedule queries", lifespan=lifespan)
+
+
+@app.get("/next")
+def next_departure(pickup: str, dropoff: str, day: date, after: time):
+    try:
+        departure = trip_index().next_departure(pickup, dropoff, day, after)
+    except KeyError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    if departure is None:
+        raise HTTPException(status_code=404, detail=f"No bus from {pickup} to {dropoff} on {day} after {after}")
+    return departure
+
+
+@app.get("/schedule")
+def day_schedule(pickup: str, dropoff: str, day: date):
+    try:
+        return trip_index().day_schedule(pickup, dropoff, day)
+    except KeyError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+
+@app.get("/stops")
+def stops():
+    return sorted(trip_index().stop_ids)
+
+
+@app.post("/reload")
+def reload():
+    '''
+    Rebuild the index from the published artifacts, called after a new workbook is processed
+    '''
+    error = try_reload_from_store()
+    if error is not None:
+        raise HTTPException(status_code=503, detail=error)
+    index = current_trip_index()
+    return {'stops': len(index.stop_ids), 'trips': len(index.routes), 'dates': len(index.dates)}
@@ -0,0 +1,123 @@
+import gzip
+import zlib
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+
+# Typed columns of every generated table, all other columns keep the type pandas gives them.
+# Times and dates are stored natively, repeated names are dictionary encoded.
+ARTIFACT_COLUMNS = {
+    "StartingTime.csv": {'route_name': 'dictionary',
+                         'pickup_point': 'dictionary',
+                         'dropoff_point': 'dictionary',
+                         'date': 'date',
+                         **{f'slot{slot}': 'time' for slot in range(1, 7)}},
+    "route_stop_times.csv": {'route_name': 'dictionary',
+                             'direction': 'dictionary',
+                             'stop_name': 'dictionary',
+                             **{f'slot{slot}': 'time' for slot in range(1, 7)}},
+    "bus_trips.csv": {'route': 'dictionary',
+                      'departure_district': 'dictionary',
+                      'arrival': 'dictionary',
+                      'departure_time': 'time',
+                      'arrival_time': 'time'},
+    "bus_schedule.csv": {'stop_name': 'dictionary',
+                         'stop_time': 'time'},
+    "bus_timetable.csv": {'day_of_week': 'dictionary',
+                          'date': 'date'},
+}
+
+# Formats the generators write times and dates in
+TIME_FORMAT = "%H:%M"
+DATE_FORMAT = "%m/%d/%Y"
+
+CSV_CONTENT_TYPE = "text/csv; charset=utf-8"
+PARQUET_CONTENT_TYPE = "application/vnd.apache.parquet"
+# Rows serialised per CSV chunk, bounds the text held in memory at once
+CSV_CHUNK_ROWS = 50_000
+GZIP_LEVEL = 6
+GZIP_MAGIC = b"\x1f\x8b"
+
+
+def parquet_path(export_path: str) -> str:
+    return export_path.rsplit(".", 1)[0] + ".parquet"
+
+
+def time_array(values: pd.Series) -> pa.Array:
+    clock = pd.to_datetime(values, format=TIME_FORMAT)
+    seconds = (clock.dt.hour * 3600 + clock.dt.minute * 60).astype("Int32")
+    return pa.array(seconds, type=pa.int32()).cast(pa.time32("s"))
+
+
+def date_array(values: pd.Series) -> pa.Array:
+    return pa.array(pd.to_datetime(values, format=DATE_FORMAT)).cast(pa.date32())
+
+
+def typed_table(export_path: str, df: pd.DataFrame) -> pa.Table:
+    '''
+    Arrow table of a generated table, converting its text columns once at generation time
+    '''
+    column_types = ARTIFACT_COLUMNS.get(export_path, {})
+    columns = {}
+    for column in df.columns:
+        kind = column_types.get(column)
+        if kind == 'time':
+            columns[column] = time_array(df[column])
+        elif kind == 'date':
+            columns[column] = date_array(df[column])
+        elif kind == 'dictionary':
+            columns[column] = pa.array(df[column], type=pa.string()).dictionary_encode()
+        else:
+            columns[column] = pa.array(df[column])
+    return pa.table(columns)
+
+
+def csv_chunks(df: pd.DataFrame, chunk_rows: int = CSV_CHUNK_ROWS):
+    '''
+    The CSV text of df in encoded chunks of chunk_rows rows, the header goes with the first one
+    '''
+    for start in range(0, max(len(df), 1), chunk_rows):
+        yield df.iloc[start:start + chunk_rows].to_csv(header=start == 0, index=False).encode('utf-8')
+
+
+def gzip_chunks(chunks, level: int = GZIP_LEVEL):
+    # wbits=31 writes the gzip container, so any gzip reader and Content-Encoding: gzip clients understand it
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def decompress(data: bytes) -> bytes:
+    '''
+    Content of an artifact whether or not it was stored gzip-compressed
+    '''
+    return gzip.decompress(data) if data[:2] == GZIP_MAGIC else data
+
+
+def parquet_bytes(table: pa.Table) -> bytes:
+    sink = pa.BufferOutputStream()
+    pq.write_table(table, sink)
+    return sink.getvalue().to_pybytes()
+
+
+def read_parquet(data: bytes) -> pa.Table:
+    # Reads straight from the downloaded buffer without copying it
+    return pq.read_table(pa.BufferReader(data))
+
+
+def to_pandas(table: pa.Table) -> pd.DataFrame:
+    '''
+    DataFrame of a typed table with plain strings, datetime.time times and datetime.date dates,
+    the values the TIME and DATE columns of the bus tables take
+    '''
+    columns = {}
+    for field, column in zip(table.schema, table.columns):
+        if pa.types.is_dictionary(field.type):
+            column = column.cast(field.type.value_type)
+        columns[field.name] = column.to_pandas()
+    return pd.DataFrame(columns)
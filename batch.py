@@ -0,0 +1,176 @@
+'''
+Reprocess an archive of weekly workbooks without the Streamlit page, e.g. after the
+parsing rules change. Every workbook is parsed and generated in its own process and
+its artifacts are written to <output>/<version>/<workbook>/ in the artifact store.
+
+    python batch.py data/
+    python batch.py --prefix archive/ --version 2024-fall --load-database
+'''
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from io import BytesIO
+
+from telemetry import pipeline_run, run_summary, start_metrics_server
+from utils import (DATABASE_ARTIFACTS, download_artifact, get_parquet_file, get_stop_ids, get_store,
+                   processing_uploaded_file, publish_artifacts, publish_stop_registry, read_workbook,
+                   update_bus_schedule_database)
+
+
+# Index of the workbooks reprocessed into one version
+BATCH_RECORD = "batch.json"
+
+
+def workbook_location(output: str, version: str, name: str) -> str:
+    stem = os.path.splitext(os.path.basename(name))[0].replace(" ", "_")
+    return f"{output}/{version}/{stem}/"
+
+
+def list_workbooks(source: str, from_store: bool) -> list:
+    '''
+    Workbooks in a local directory or under a store prefix, by name. Archives are
+    named by week, so the last one is the most recent.
+    '''
+    if from_store:
+        names = get_store().list_names(source)
+    else:
+        names = [os.path.join(source, name) for name in os.listdir(source)]
+    return sorted(name for name in names if name.endswith(".xlsx") and not os.path.basename(name).startswith("~$"))
+
+
+def read_source(name: str, from_store: bool) -> bytes:
+    if from_store:
+        return download_artifact(name)
+    with open(name, "rb") as f:
+        return f.read()
+
+
+def shared_stop_ids(workbooks: list, from_store: bool, stop_ids: dict) -> dict:
+    '''
+    One stop registry for the whole batch: the stops of every workbook are numbered in
+    archive order on top of stop_ids, so workers never give one id to two stops
+    '''
+    for name in workbooks:
+        try:
+            stop_ids = read_workbook(BytesIO(read_source(name, from_store)), stop_ids).stops.ids
+        except Exception as e:
+            # Its worker fails on the same workbook and reports it
+            print(f"Not numbering the stops of {name}: {e!r}", file=sys.stderr)
+    return stop_ids
+
+
+def reprocess_workbook(name: str, from_store: bool, location: str, stop_ids: dict) -> dict:
+    '''
+    Generate and publish the artifacts of one workbook under location, in a worker process
+    '''
+    start = time.perf_counter()
+    data = read_source(name, from_store)
+    with pipeline_run() as records:
+        tables, uploads = processing_uploaded_file(os.path.basename(name), BytesIO(data), export_prefix=location,
+                                                   stop_ids=stop_ids)
+        publish_artifacts(uploads)
+    return {'workbook': name,
+            'sha256': hashlib.sha256(data).hexdigest(),
+            'location': location,
+            'rows': {export_path: len(table) for export_path, table in tables.items() if export_path.endswith(".csv")},
+            'bytes': sum(record['bytes'] or 0 for record in run_summary(records) if record['stage'].startswith("commit")),
+            'seconds': round(time.perf_counter() - start, 3)}
+
+
+def reprocess(workbooks: list, from_store: bool, output: str, version: str, stop_ids: dict,
+              workers: int = None) -> list:
+    '''
+    Reprocess workbooks in a process pool. Failures are reported per workbook, the
+    others still finish. Returns one result per workbook in the order given.
+    '''
+    results = {}
+    # Spawned workers start clean instead of inheriting the parent's clients and executor threads
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+        futures = {executor.submit(reprocess_workbook, name, from_store, workbook_location(output, version, name),
+                                   stop_ids): name
+                   for name in workbooks}
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                results[name] = future.result()
+            except Exception as e:
+                traceback.print_exception(e)
+                results[name] = {'workbook': name, 'location': workbook_location(output, version, name), 'error': f"{e!r}"}
+            status = results[name].get('error') or f"{results[name]['seconds']:.2f}s"
+            print(f"[{len(results)}/{len(workbooks)}] {name}: {status}", file=sys.stderr)
+    return [results[name] for name in workbooks]
+
+
+def load_database(result: dict, stop_ids: dict):
+    # The database now refers to the batch's stop ids, later uploads must number on from them
+    publish_stop_registry(stop_ids)
+    update_bus_schedule_database({name: get_parquet_file(result['location'] + name) for name in DATABASE_ARTIFACTS},
+                                 workbook={'name': result['workbook'], 'sha256': result['sha256']})
+
+
+def main(argv: list = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("source", nargs="?", help="directory of .xlsx workbooks")
+    parser.add_argument("--prefix", help="reprocess the workbooks under this artifact store prefix instead")
+    parser.add_argument("--output", default="reprocessed", help="store prefix the versions are written under")
+    parser.add_argument("--version", default=time.strftime("%Y%m%dT%H%M%S"),
+                        help="name of this reprocessing run, a timestamp by default")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes, one per CPU by default")
+    parser.add_argument("--load-database", action="store_true",
+                        help="load the most recent workbook's outputs into the database at the end")
+    args = parser.parse_args(argv)
+    if (args.source is None) == (args.prefix is None):
+        parser.error("give either a source directory or --prefix")
+    if os.getenv("ARTIFACT_STORE") == 'memory':
+        parser.error("the in-memory store is private to each worker process, use ARTIFACT_STORE=local or azure")
+
+    # Only this process serves metrics, the workers would all ask for the same port
+    start_metrics_server()
+
+    from_store = args.prefix is not None
+    workbooks = list_workbooks(args.prefix if from_store else args.source, from_store)
+    if not workbooks:
+        parser.error("no .xlsx workbooks found")
+    # "Bus schedules.xlsx" and "Bus_schedules.xlsx" would overwrite each other's outputs
+    locations = {}
+    for name in workbooks:
+        first = locations.setdefault(workbook_location(args.output, args.version, name), name)
+        if first != name:
+            print(f"Skipping {name}, it is written to the same location as {first}", file=sys.stderr)
+    workbooks = list(locations.values())
+    print(f"Reprocessing {len(workbooks)} workbooks into {args.output}/{args.version}/", file=sys.stderr)
+    start = time.perf_counter()
+    published_stop_ids = get_stop_ids()
+    stop_ids = shared_stop_ids(workbooks, from_store, published_stop_ids)
+    results = reprocess(workbooks, from_store, args.output, args.version, stop_ids, args.workers)
+    failed = [result['workbook'] for result in results if 'error' in result]
+
+    record = {'version': args.version,
+              'created_at': time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+              'seconds': round(time.perf_counter() - start, 3),
+              'workbooks': results}
+    get_store().upload(f"{args.output}/{args.version}/{BATCH_RECORD}", [json.dumps(record, indent=2).encode('utf-8')])
+    print(f"Reprocessed {len(results) - len(failed)} of {len(results)} workbooks in {record['seconds']:.1f}s",
+          file=sys.stderr)
+
+    if args.load_database:
+        latest = results[-1]
+        if 'error' in latest:
+            print(f"Not loading the database, the most recent workbook {latest['workbook']} failed", file=sys.stderr)
+            return 1
+        if get_stop_ids() != published_stop_ids:
+            print("Not loading the database, a workbook was published during the batch and its stops "
+                  "may have taken the batch's new ids. Run the batch again.", file=sys.stderr)
+            return 1
+        load_database(latest, stop_ids)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,79 @@
+'''
+Peak memory and stored bytes of the CSV artifact writer on a large synthetic
+bus_schedule table: one whole-table to_csv string against streamed chunks,
+plain and gzip-compressed, uploaded to a local artifact store.
+
+Run from the repository root:
+    python benchmarks/bench_csv_artifacts.py --rows 500000
+'''
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import redirect_stdout
+from io import StringIO
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import utils
+from artifacts import CSV_CONTENT_TYPE, csv_chunks
+
+
+def schedule_table(n_rows: int) -> pd.DataFrame:
+    # Same shape and repetitiveness as bus_schedule.csv
+    stops = np.array([f"Stop {i}" for i in range(60)], dtype=object)
+    minutes = np.arange(n_rows) % (16 * 60) + 6 * 60
+    return pd.DataFrame({'trip_id': np.arange(n_rows) // 10 + 1,
+                         'stop_sequence': np.arange(n_rows) % 10 + 1,
+                         'stop_id': np.arange(n_rows) % 60 + 1,
+                         'stop_name': stops[np.arange(n_rows) % 60],
+                         'stop_time': [f"{m // 60:02d}:{m % 60:02d}" for m in minutes]})
+
+
+def whole_table(df: pd.DataFrame):
+    # The writer before streaming: one string, then one bytes copy of it
+    yield df.to_csv(index=False).encode('utf-8')
+
+
+def measure(name: str, df: pd.DataFrame, serialize, content_encoding: str = None):
+    tracemalloc.reset_peak()
+    before = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    with redirect_stdout(StringIO()):
+        artifact = utils.stage_artifact(name, serialize, df, CSV_CONTENT_TYPE, content_encoding)
+        artifact['commit']()
+    seconds = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1] - before
+    print(f"{name:<24} {seconds:>9.2f} {peak / 2 ** 20:>11.1f} {artifact['bytes'] / 2 ** 20:>11.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=500_000)
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp()
+    os.environ["ARTIFACT_STORE"] = "local"
+    os.environ["ARTIFACT_STORE_PATH"] = root
+    utils.get_store.cache_clear()
+    df = schedule_table(args.rows)
+    print(f"{args.rows} rows")
+    print(f"{'writer':<24} {'wall (s)':>9} {'peak (MiB)':>11} {'stored (MiB)':>11}")
+    tracemalloc.start()
+    try:
+        measure("whole table", df, whole_table)
+        measure("streamed", df, csv_chunks)
+        measure("streamed gzip", df, csv_chunks, 'gzip')
+    finally:
+        tracemalloc.stop()
+        shutil.rmtree(root)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+'''
+Parse time of the sample workbooks in data/ with each Excel engine, and a check
+that every engine yields the same generated tables.
+
+Run from the repository root:
+    python benchmarks/bench_excel_engines.py
+'''
+import glob
+import os
+import sys
+import time
+from contextlib import redirect_stdout
+from io import StringIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils import PIPELINE_STAGES
+from workbook import EXCEL_ENGINES, open_workbook, parse_workbook
+
+
+REPEATS = 5
+DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data")
+
+
+def parse(path: str, engine: str):
+    with open(path, "rb") as f:
+        return parse_workbook(open_workbook(f, engine=engine))
+
+
+def generate_tables(workbook) -> dict:
+    tables = {}
+    for export_path, (generator, inputs) in PIPELINE_STAGES.items():
+        tables[export_path] = generator(workbook, *[tables[name] for name in inputs])
+    return {export_path: df.to_csv(index=False) for export_path, df in tables.items()}
+
+
+def main():
+    print(f"{'workbook':<45} {'engine':<10} {'best (s)':>9} {'speedup':>8}")
+    for path in sorted(glob.glob(os.path.join(DATA_DIR, "*.xlsx"))):
+        timings = {}
+        outputs = {}
+        for engine in EXCEL_ENGINES:
+            best = float("inf")
+            with redirect_stdout(StringIO()):
+                for _ in range(REPEATS):
+                    start = time.perf_counter()
+                    workbook = parse(path, engine)
+                    best = min(best, time.perf_counter() - start)
+                outputs[engine] = generate_tables(workbook)
+            timings[engine] = best
+
+        baseline = timings['openpyxl']
+        for engine, seconds in timings.items():
+            print(f"{os.path.basename(path):<45} {engine:<10} {seconds:>9.4f} {baseline / seconds:>7.1f}x")
+        reference = outputs['openpyxl']
+        for engine, tables in outputs.items():
+            assert tables == reference, f"{engine} tables differ from openpyxl on {path}"
+    print("All engines produced identical tables")
+
+
+if __name__ == "__main__":
+    main()
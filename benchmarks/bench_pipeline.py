@@ -0,0 +1,108 @@
+'''
+End-to-end pipeline benchmark on a synthetic workbook, against local stand-ins:
+the in-memory artifact store and, optionally, a local PostgreSQL database.
+Reports wall time, peak traced memory and row counts per stage.
+
+Run from the repository root:
+    python benchmarks/bench_pipeline.py --routes 10 --stops 20 --weeks 18
+    python benchmarks/bench_pipeline.py --database-url postgresql+psycopg://postgres@localhost/buv
+'''
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+from contextlib import redirect_stdout
+from io import BytesIO, StringIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import utils
+from database import FINGERPRINT_TABLE
+from synthetic_workbook import synthetic_workbook
+from workbook import open_workbook, parse_workbook
+
+
+class StageTimer:
+    def __init__(self):
+        self.results = []
+
+    def run(self, stage, func, *args, rows=None, nbytes=None):
+        tracemalloc.reset_peak()
+        memory_before = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        with redirect_stdout(StringIO()):
+            result = func(*args)
+        seconds = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1] - memory_before
+        self.results.append((stage,
+                             seconds,
+                             peak / 2**20,
+                             rows(result) if rows else None,
+                             nbytes(result) if nbytes else None))
+        return result
+
+    def report(self):
+        print(f"{'stage':<28} {'wall (s)':>9} {'peak (MiB)':>11} {'rows':>9} {'bytes':>11}")
+        for stage, seconds, peak, rows, nbytes in self.results:
+            print(f"{stage:<28} {seconds:>9.4f} {peak:>11.2f} "
+                  f"{'' if rows is None else rows:>9} {'' if nbytes is None else nbytes:>11}")
+        print(f"{'total':<28} {sum(result[1] for result in self.results):>9.4f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--routes", type=int, default=5)
+    parser.add_argument("--stops", type=int, default=8, help="stops per route direction")
+    parser.add_argument("--weeks", type=int, default=1, help="calendar weeks")
+    parser.add_argument("--engine", default=None, help="Excel engine, defaults to EXCEL_ENGINE")
+    parser.add_argument("--database-url", default=os.getenv("BENCH_DATABASE_URL"),
+                        help="local PostgreSQL to load into, the database stages are skipped without one")
+    args = parser.parse_args()
+
+    data, layout = synthetic_workbook(args.routes, args.stops, args.weeks)
+    print(f"Synthetic workbook: {args.routes} routes, {args.stops} stops, {args.weeks} weeks, {len(data)} bytes")
+
+    os.environ["ARTIFACT_STORE"] = "memory"
+    utils.get_store.cache_clear()
+    store = utils.get_store()
+    if args.database_url:
+        os.environ["DATABASE_URL"] = args.database_url
+        utils.get_engine.cache_clear()
+
+    timer = StageTimer()
+    tracemalloc.start()
+    try:
+        uploaded_file = BytesIO(data)
+        uploaded = timer.run("upload workbook", utils.upload_to_blob_storage, "synthetic schedule.xlsx", uploaded_file,
+                  nbytes=lambda result: len(data))
+        bus_calender_file = timer.run("open workbook", open_workbook, uploaded_file, args.engine)
+        workbook = timer.run("parse workbook", parse_workbook, bus_calender_file, layout,
+                             rows=lambda result: sum(len(route.outbound_stops) + len(route.return_stops)
+                                                     for route in result.routes.values()) + len(result.calendar.days))
+
+        tables = {}
+        uploads = {}
+        for export_path, (generator, inputs) in utils.PIPELINE_STAGES.items():
+            tables[export_path] = timer.run(f"generate {export_path}", generator, workbook,
+                                            *[tables[name] for name in inputs], rows=len)
+            uploads.update(timer.run(f"type {export_path}", utils.stage_artifacts, tables, export_path))
+        timer.run("publish artifacts", utils.publish_artifacts, uploads, uploaded,
+                  nbytes=lambda result: sum(len(store.download(name)) for name in result))
+
+        if args.database_url:
+            total_rows = lambda result: sum(len(tables[name]) for name in ("bus_trips.csv", "bus_schedule.csv", "bus_timetable.csv"))
+            with utils.get_engine().begin() as connection:
+                connection.exec_driver_sql(f'DROP TABLE IF EXISTS "{FINGERPRINT_TABLE}"')
+            timer.run("database load (full)", utils.update_bus_schedule_database, tables, rows=total_rows)
+            timer.run("database load (unchanged)", utils.update_bus_schedule_database, tables, rows=total_rows)
+    finally:
+        tracemalloc.stop()
+
+    timer.report()
+    if not args.database_url:
+        print("No --database-url given, database stages skipped")
+
+
+if __name__ == "__main__":
+    main()
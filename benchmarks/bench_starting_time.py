@@ -0,0 +1,85 @@
+'''
+Scaling of the StartingTime.csv builder with the number of stops per route,
+next to the linear stop-time grid segments are derived from on demand.
+
+Run from the repository root:
+    python benchmarks/bench_starting_time.py
+'''
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils import generate_route_stop_times, generate_starting_time
+from workbook import ROUTE_SHEETS, BusWorkbook, RouteSheet
+
+
+STOP_COUNTS = (5, 10, 20, 40, 80, 160)
+# The per-row concat builder is quadratic, only time it on the smaller sheets
+LEGACY_MAX_STOPS = 20
+
+
+def synthetic_route(name: str, n_stops: int) -> RouteSheet:
+    start = datetime(1900, 1, 1, 7, 0)
+
+    def grid(n_slots):
+        return np.array([[(start + timedelta(hours=slot, minutes=2 * stop)).time()
+                          for slot in range(n_slots)]
+                         for stop in range(n_stops)], dtype=object)
+
+    stops = np.array([f"{name} STOP {i}" for i in range(n_stops - 1)] + ["BUV CAMPUS"], dtype=object)
+    return RouteSheet(name=name,
+                      outbound_stops=stops,
+                      outbound_times=grid(5),
+                      return_stops=stops[::-1].copy(),
+                      return_times=grid(6))
+
+
+def legacy_starting_time(workbook: BusWorkbook) -> pd.DataFrame:
+    # Row-by-row pd.concat builder that generate_starting_time replaced
+    df = pd.DataFrame(columns=['route_name', 'pickup_point', 'dropoff_point', 'date',
+                               'slot1', 'slot2', 'slot3', 'slot4', 'slot5', 'slot6'])
+    for route_name, route in workbook.routes.items():
+        for stops, times in ((route.outbound_stops, route.outbound_times),
+                             (route.return_stops, route.return_times)):
+            for i in range(len(stops)):
+                for j in range(i + 1, len(stops)):
+                    new_row_data = {'route_name': route_name.title(),
+                                    'pickup_point': workbook.stops.stop_names(stops[i:i + 1])[0],
+                                    'dropoff_point': workbook.stops.stop_names(stops[j:j + 1])[0],
+                                    'date': None}
+                    for k in range(1, 6):
+                        new_row_data[f'slot{k}'] = times[i][k - 1].strftime("%H:%M")
+                    df = pd.concat([df, pd.DataFrame([new_row_data])], ignore_index=True)
+    return df
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def main():
+    print(f"{'stops':>6} {'rows':>8} {'legacy (s)':>11} {'vectorized (s)':>15} {'grid rows':>10} {'grid (s)':>9}")
+    for n_stops in STOP_COUNTS:
+        workbook = BusWorkbook(routes={name: synthetic_route(name, n_stops) for name in ROUTE_SHEETS},
+                               calendar=None)
+        df, vectorized = timed(generate_starting_time, workbook)
+        grid, grid_seconds = timed(generate_route_stop_times, workbook)
+
+        legacy = "-"
+        if n_stops <= LEGACY_MAX_STOPS:
+            legacy_df, seconds = timed(legacy_starting_time, workbook)
+            assert legacy_df.to_csv(index=False) == df.to_csv(index=False)
+            legacy = f"{seconds:.3f}"
+        print(f"{n_stops:>6} {len(df):>8} {legacy:>11} {vectorized:>15.4f} {len(grid):>10} {grid_seconds:>9.4f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+'''
+Synthetic schedule workbooks in the layout of data/Bus_schedules_for_Chatbot_20240905.xlsx,
+with a configurable number of routes, stops per route and calendar weeks.
+'''
+import os
+import sys
+from datetime import date, datetime, time, timedelta
+from io import BytesIO
+
+from openpyxl import Workbook
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from layout import BUS_WORKBOOK, compile_layout
+
+
+ROUTE_SHEETS = BUS_WORKBOOK.route_sheets
+# Slot counts are fixed by the workbook layout the parser reads
+OUTBOUND_SLOTS = compile_layout().outbound_slots
+RETURN_SLOTS = compile_layout().return_slots
+CALENDAR_CODES = BUS_WORKBOOK.calendar.route_codes
+DAY_ABBREVIATIONS = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri')
+
+
+def route_names(n_routes: int) -> tuple:
+    '''
+    Route sheet names in trip_id order. The last route has no calendar rows and
+    follows HBT, like Ecopark does.
+    '''
+    if n_routes < 2:
+        raise ValueError("A schedule workbook needs at least 2 routes")
+    names = list(ROUTE_SHEETS[:-1][:n_routes - 1])
+    names += [f"Route {i}" for i in range(len(names) + 1, n_routes)]
+    return tuple(names) + (ROUTE_SHEETS[-1],)
+
+
+def slot_time(start_minutes: int, offset_minutes: int) -> time:
+    minutes = (start_minutes + offset_minutes) % (24 * 60)
+    return time(minutes // 60, minutes % 60)
+
+
+def write_route_sheet(workbook: Workbook, name: str, n_stops: int):
+    sheet = workbook.create_sheet(name)
+    sheet.cell(row=2, column=1, value=f"{name.upper()} ROUTE")
+    sheet.cell(row=4, column=1, value="Pick-up point")
+    sheet.cell(row=4, column=8, value="Drop-off point")
+    for slot in range(OUTBOUND_SLOTS):
+        sheet.cell(row=4, column=2 + slot, value=f"Slot {slot + 1}")
+    for slot in range(RETURN_SLOTS):
+        sheet.cell(row=4, column=9 + slot, value=f"Slot {slot + 1}")
+
+    stops = [f"{name.upper()} STOP {i + 1}" for i in range(n_stops - 1)] + ["BUV CAMPUS"]
+    return_stops = ["BUV CAMPUS"] + stops[-2::-1]
+    for i in range(n_stops):
+        row = 5 + i
+        sheet.cell(row=row, column=1, value=stops[i])
+        sheet.cell(row=row, column=8, value=return_stops[i])
+        for slot in range(OUTBOUND_SLOTS):
+            cell = sheet.cell(row=row, column=2 + slot, value=slot_time(7 * 60 + 120 * slot, 3 * i))
+            cell.number_format = 'h:mm'
+        for slot in range(RETURN_SLOTS):
+            cell = sheet.cell(row=row, column=9 + slot, value=slot_time(11 * 60 + 30 + 60 * slot, 3 * i))
+            cell.number_format = 'h:mm'
+
+
+def write_calendar_sheet(workbook: Workbook, codes: tuple, n_weeks: int, start: date):
+    end = start + timedelta(weeks=n_weeks - 1, days=4)
+    sheet = workbook.create_sheet(f"{start:%d.%m} - {end:%d.%m}")
+    sheet.cell(row=6, column=1, value="WEEKLY NUMBER OF BUSES")
+    sheet.cell(row=7, column=5, value=datetime.combine(start, time()))
+    sheet.cell(row=7, column=8, value=datetime.combine(end, time()))
+    for column, header in ((1, "Date"), (2, "DAY"), (3, "Route"), (4, "HANOI - BUV CAMPUS"), (9, "BUV CAMPUS - HANOI")):
+        sheet.cell(row=9, column=column, value=header)
+    for slot in range(OUTBOUND_SLOTS):
+        sheet.cell(row=10, column=4 + slot, value=slot_time(7 * 60 + 120 * slot, 0))
+    for slot in range(RETURN_SLOTS):
+        sheet.cell(row=10, column=9 + slot, value=slot_time(11 * 60 + 30 + 60 * slot, 0))
+
+    row = 11
+    for day in range(n_weeks * 7):
+        current = start + timedelta(days=day)
+        if current.weekday() >= len(DAY_ABBREVIATIONS):
+            continue
+        for route, code in enumerate(codes):
+            sheet.cell(row=row, column=1, value=datetime.combine(current, time()))
+            sheet.cell(row=row, column=2, value=DAY_ABBREVIATIONS[current.weekday()])
+            sheet.cell(row=row, column=3, value=code)
+            # Deterministic mix of running and cancelled slots
+            for slot in range(OUTBOUND_SLOTS + RETURN_SLOTS):
+                sheet.cell(row=row, column=4 + slot, value=int((day + route + slot) % 4 != 0))
+            row += 1
+
+
+def synthetic_workbook(n_routes: int = 5, n_stops: int = 8, n_weeks: int = 1,
+                       start: date = date(2024, 9, 9)) -> tuple:
+    '''
+    Build a schedule workbook, returning its .xlsx bytes and its layout
+    '''
+    routes = route_names(n_routes)
+    codes = CALENDAR_CODES[:n_routes - 1] + tuple(f"R{i}" for i in range(len(CALENDAR_CODES) + 1, n_routes))
+
+    workbook = Workbook()
+    workbook.remove(workbook.active)
+    for name in routes:
+        write_route_sheet(workbook, name, n_stops)
+    write_calendar_sheet(workbook, codes, n_weeks, start)
+
+    output = BytesIO()
+    workbook.save(output)
+    return output.getvalue(), BUS_WORKBOOK.with_routes(routes, codes)
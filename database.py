@@ -0,0 +1,497 @@
+import hashlib
+from datetime import date, timedelta
+
+import pandas as pd
+from sqlalchemy import (BigInteger, Column, Date, ForeignKeyConstraint, Index, MetaData,
+                        PrimaryKeyConstraint, Table, Text, Time, inspect, text)
+
+from telemetry import stage
+
+
+# Schema owned by the bus schedule loader, parents before children.
+# Times of day and dates are stored as TIME and DATE.
+metadata = MetaData()
+BUS_SCHEMA = {
+    "stops": Table("stops", metadata,
+                   Column("stop_id", BigInteger, nullable=False),
+                   Column("stop_name", Text, nullable=False),
+                   PrimaryKeyConstraint("stop_id", name="stops_pkey")),
+    "bus_trips": Table("bus_trips", metadata,
+                       Column("trip_id", BigInteger, nullable=False),
+                       Column("route", Text, nullable=False),
+                       Column("departure_district", Text, nullable=False),
+                       Column("arrival", Text, nullable=False),
+                       Column("departure_time", Time, nullable=False),
+                       Column("arrival_time", Time, nullable=False),
+                       PrimaryKeyConstraint("trip_id", name="bus_trips_pkey"),
+                       Index("bus_trips_route_idx", "route")),
+    "bus_schedule": Table("bus_schedule", metadata,
+                          Column("trip_id", BigInteger, nullable=False),
+                          Column("stop_sequence", BigInteger, nullable=False),
+                          Column("stop_id", BigInteger, nullable=False),
+                          Column("stop_name", Text, nullable=False),
+                          Column("stop_time", Time, nullable=False),
+                          PrimaryKeyConstraint("trip_id", "stop_sequence", name="bus_schedule_pkey"),
+                          ForeignKeyConstraint(["trip_id"], ["bus_trips.trip_id"], name="bus_schedule_trip_id_fkey"),
+                          ForeignKeyConstraint(["stop_id"], ["stops.stop_id"], name="bus_schedule_stop_id_fkey"),
+                          Index("bus_schedule_stop_name_stop_time_idx", "stop_name", "stop_time")),
+    "bus_timetable": Table("bus_timetable", metadata,
+                           Column("day_of_week", Text, nullable=False),
+                           Column("trip_id", BigInteger, nullable=False),
+                           Column("date", Date, nullable=False),
+                           ForeignKeyConstraint(["trip_id"], ["bus_trips.trip_id"], name="bus_timetable_trip_id_fkey"),
+                           Index("bus_timetable_date_trip_id_idx", "date", "trip_id")),
+}
+BUS_TABLES = tuple(BUS_SCHEMA)
+# Rows are fingerprinted and diffed per key: per stop for stops, per trip for the others
+TABLE_KEYS = {"stops": "stop_id", "bus_trips": "trip_id", "bus_schedule": "trip_id", "bus_timetable": "trip_id"}
+# Tables whose rows of a trip are replaced wholesale when the trip changes
+TRIP_TABLES = ("bus_schedule", "bus_timetable")
+STAGING_SUFFIX = "_staging"
+COPY_CHUNK_ROWS = 10000
+# Content hash of every key in every loaded table, as of the last load.
+# Its trip_id column holds the table's key, the stop_id for stops.
+FINGERPRINT_TABLE = "bus_load_fingerprints"
+
+# Every (pickup, dropoff) segment of every trip on every date it runs, refreshed with the tables
+SEGMENT_VIEW = "bus_segments"
+SEGMENT_VIEW_INDEXES = (
+    ("bus_segments_key_idx", "UNIQUE", "trip_id, pickup_sequence, dropoff_sequence, date"),
+    ("bus_segments_lookup_idx", "", "pickup, dropoff, date, departure_time"),
+)
+
+# Every loaded week stays queryable in <table>_history, range partitioned by week.
+# Each workbook becomes one partition per table, named and commented with its hash,
+# and schedule_versions lists the weeks with the workbook they came from.
+HISTORY_SUFFIX = "_history"
+# Partition column of each history table, the timetable by its own date and the others by week
+HISTORY_PARTITION_KEYS = {"stops": "week_start", "bus_trips": "week_start",
+                          "bus_schedule": "week_start", "bus_timetable": "date"}
+VERSION_TABLE = "schedule_versions"
+# A full academic year online, older weeks are detached and dropped
+HISTORY_WEEKS = 52
+
+
+def copy_dataframe(cursor, table_name: str, df: pd.DataFrame):
+    '''
+    Stream a DataFrame into a table with COPY ... FROM STDIN, chunk by chunk
+    '''
+    columns = ", ".join(f'"{column}"' for column in df.columns)
+    with stage("copy", table=table_name) as record, \
+            cursor.copy(f'COPY "{table_name}" ({columns}) FROM STDIN (FORMAT csv)') as copy:
+        record.rows, record.bytes = len(df), 0
+        for start in range(0, len(df), COPY_CHUNK_ROWS):
+            chunk = df.iloc[start:start + COPY_CHUNK_ROWS].to_csv(header=False, index=False).encode('utf-8')
+            copy.write(chunk)
+            record.bytes += len(chunk)
+
+
+def segment_view_sql(suffix: str = "") -> str:
+    return (f'CREATE MATERIALIZED VIEW "{SEGMENT_VIEW}{suffix}" AS '
+            f'SELECT p.trip_id, p.stop_sequence AS pickup_sequence, d.stop_sequence AS dropoff_sequence, '
+            f'p.stop_id AS pickup_stop_id, p.stop_name AS pickup, d.stop_id AS dropoff_stop_id, d.stop_name AS dropoff, '
+            f't.date, p.stop_time AS departure_time, d.stop_time AS arrival_time '
+            f'FROM "bus_schedule{suffix}" p '
+            f'JOIN "bus_schedule{suffix}" d ON d.trip_id = p.trip_id AND d.stop_sequence > p.stop_sequence '
+            f'JOIN "bus_timetable{suffix}" t ON t.trip_id = p.trip_id')
+
+
+def staging_keys(table_name: str) -> list:
+    '''
+    DDL adding the keys and indexes of the schema to the staging copy of a table.
+    Returns (create statement, rename-back statement) pairs.
+    '''
+    table = BUS_SCHEMA[table_name]
+    staging_name = table_name + STAGING_SUFFIX
+    keys = []
+
+    pk = table.primary_key
+    if pk.columns:
+        columns = ", ".join(f'"{column.name}"' for column in pk.columns)
+        keys.append((f'ALTER TABLE "{staging_name}" ADD CONSTRAINT "{pk.name}{STAGING_SUFFIX}" PRIMARY KEY ({columns})',
+                     f'ALTER TABLE "{table_name}" RENAME CONSTRAINT "{pk.name}{STAGING_SUFFIX}" TO "{pk.name}"'))
+
+    for index in sorted(table.indexes, key=lambda index: index.name):
+        columns = ", ".join(f'"{column.name}"' for column in index.columns)
+        unique = "UNIQUE " if index.unique else ""
+        keys.append((f'CREATE {unique}INDEX "{index.name}{STAGING_SUFFIX}" ON "{staging_name}" ({columns})',
+                     f'ALTER INDEX "{index.name}{STAGING_SUFFIX}" RENAME TO "{index.name}"'))
+
+    for fk in table.foreign_key_constraints:
+        # Keys between loader tables point at the staging copy so the swap carries them over
+        referred_table = fk.referred_table.name + STAGING_SUFFIX
+        columns = ", ".join(f'"{column}"' for column in fk.column_keys)
+        referred_columns = ", ".join(f'"{element.column.name}"' for element in fk.elements)
+        keys.append((f'ALTER TABLE "{staging_name}" ADD CONSTRAINT "{fk.name}{STAGING_SUFFIX}" '
+                     f'FOREIGN KEY ({columns}) REFERENCES "{referred_table}" ({referred_columns})',
+                     f'ALTER TABLE "{table_name}" RENAME CONSTRAINT "{fk.name}{STAGING_SUFFIX}" TO "{fk.name}"'))
+    return keys
+
+
+def bare_table(table_name: str, name: str) -> Table:
+    '''
+    Table with the columns of a schema table under another name, without keys or indexes
+    '''
+    return Table(name, MetaData(), *[Column(column.name, column.type, nullable=column.nullable)
+                                     for column in BUS_SCHEMA[table_name].columns])
+
+
+def outdated_tables(connection) -> list:
+    '''
+    Loader tables that are missing or whose columns, types or indexes differ from the schema
+    '''
+    inspector = inspect(connection)
+    outdated = []
+    for table_name, table in BUS_SCHEMA.items():
+        if not inspector.has_table(table_name):
+            outdated.append(table_name)
+            continue
+        live_columns = [(column["name"], column["type"].compile(connection.dialect))
+                        for column in inspector.get_columns(table_name)]
+        columns = [(column.name, column.type.compile(connection.dialect)) for column in table.columns]
+        live_indexes = {index["name"] for index in inspector.get_indexes(table_name)}
+        if live_columns != columns or not {index.name for index in table.indexes} <= live_indexes:
+            outdated.append(table_name)
+    if SEGMENT_VIEW not in inspector.get_materialized_view_names():
+        outdated.append(SEGMENT_VIEW)
+    return outdated
+
+
+def key_fingerprints(table_name: str, df: pd.DataFrame) -> pd.DataFrame:
+    '''
+    One content hash per key of the table over that key's rows, in row order
+    '''
+    row_hashes = pd.util.hash_pandas_object(df, index=False)
+    fingerprints = row_hashes.groupby(df[TABLE_KEYS[table_name]].to_numpy(), sort=False).agg(
+        lambda hashes: hashlib.sha1(hashes.to_numpy().tobytes()).hexdigest())
+    return pd.DataFrame({'table_name': table_name,
+                         'trip_id': fingerprints.index.astype('int64'),
+                         'fingerprint': fingerprints.to_numpy()})
+
+
+def ensure_fingerprint_table(connection):
+    connection.exec_driver_sql(
+        f'CREATE TABLE IF NOT EXISTS "{FINGERPRINT_TABLE}" ('
+        f'table_name text NOT NULL, trip_id bigint NOT NULL, fingerprint text NOT NULL, '
+        f'PRIMARY KEY (table_name, trip_id))')
+
+
+def update_bus_tables(engine, tables: dict):
+    '''
+    Bring the bus tables in line with the generated tables, writing only what changed.
+    Falls back to a full staged load when there is nothing to diff against.
+    '''
+    with stage("fingerprint tables"):
+        fingerprints = {table_name: key_fingerprints(table_name, tables[table_name]) for table_name in BUS_TABLES}
+
+    with engine.begin() as connection:
+        ensure_fingerprint_table(connection)
+        stored = pd.read_sql(f'SELECT table_name, trip_id, fingerprint FROM "{FINGERPRINT_TABLE}"', connection)
+        outdated = outdated_tables(connection)
+
+    if stored.empty or outdated:
+        load_bus_tables(engine, tables, pd.concat(fingerprints.values(), ignore_index=True))
+        return
+
+    # Per table: keys whose rows changed or are new, and keys that disappeared
+    changes = {}
+    for table_name in BUS_TABLES:
+        old = stored[stored['table_name'] == table_name].set_index('trip_id')['fingerprint']
+        new = fingerprints[table_name].set_index('trip_id')['fingerprint']
+        changed = [int(key) for key in new.index if old.get(key) != new[key]]
+        removed = [int(key) for key in old.index.difference(new.index)]
+        if changed or removed:
+            changes[table_name] = (changed, removed)
+
+    if not changes:
+        print("Bus schedule is unchanged, skipping the database update")
+        return
+
+    with engine.begin() as connection:
+        cursor = connection.connection.dbapi_connection.cursor()
+        # Children lose the rows of changed and removed trips first, so trips can be deleted
+        for table_name in reversed(TRIP_TABLES):
+            if table_name in changes:
+                changed, removed = changes[table_name]
+                connection.exec_driver_sql(f'DELETE FROM "{table_name}" WHERE trip_id = ANY(%s)', (changed + removed,))
+
+        # Schedule rows of a renamed or removed stop changed with it and are already gone
+        if "stops" in changes:
+            changed, removed = changes["stops"]
+            connection.exec_driver_sql('DELETE FROM "stops" WHERE stop_id = ANY(%s)', (changed + removed,))
+            stops = tables["stops"]
+            copy_dataframe(cursor, "stops", stops[stops['stop_id'].isin(changed)])
+
+        if "bus_trips" in changes:
+            changed, removed = changes["bus_trips"]
+            trips = tables["bus_trips"]
+            connection.exec_driver_sql(
+                'CREATE TEMP TABLE "bus_trips_changes" (LIKE "bus_trips") ON COMMIT DROP')
+            copy_dataframe(cursor, "bus_trips_changes", trips[trips['trip_id'].isin(changed)])
+            columns = [column for column in trips.columns if column != 'trip_id']
+            assignments = ", ".join(f'"{column}" = c."{column}"' for column in columns)
+            connection.exec_driver_sql(
+                f'UPDATE "bus_trips" t SET {assignments} FROM "bus_trips_changes" c WHERE t.trip_id = c.trip_id')
+            connection.exec_driver_sql(
+                'INSERT INTO "bus_trips" SELECT c.* FROM "bus_trips_changes" c '
+                'WHERE NOT EXISTS (SELECT 1 FROM "bus_trips" t WHERE t.trip_id = c.trip_id)')
+            connection.exec_driver_sql('DELETE FROM "bus_trips" WHERE trip_id = ANY(%s)', (removed,))
+
+        for table_name in TRIP_TABLES:
+            if table_name in changes:
+                changed, removed = changes[table_name]
+                df = tables[table_name]
+                copy_dataframe(cursor, table_name, df[df['trip_id'].isin(changed)])
+
+        for table_name, (changed, removed) in changes.items():
+            connection.exec_driver_sql(
+                f'DELETE FROM "{FINGERPRINT_TABLE}" WHERE table_name = %s AND trip_id = ANY(%s)',
+                (table_name, changed + removed))
+            table_fingerprints = fingerprints[table_name]
+            copy_dataframe(cursor, FINGERPRINT_TABLE, table_fingerprints[table_fingerprints['trip_id'].isin(changed)])
+
+        # Readers keep querying the previous segments while the view is rebuilt
+        with stage("refresh segment view"):
+            connection.exec_driver_sql(f'REFRESH MATERIALIZED VIEW CONCURRENTLY "{SEGMENT_VIEW}"')
+
+    for table_name, (changed, removed) in changes.items():
+        print(f"Updated {table_name}: {len(changed)} {TABLE_KEYS[table_name]}s changed or added, {len(removed)} removed")
+
+
+def load_bus_tables(engine, tables: dict, fingerprints: pd.DataFrame):
+    '''
+    Bulk load the bus tables through staging tables and swap them in atomically.
+    Readers keep seeing the previous tables until the swap commits.
+    '''
+    # Create any missing live table, the swap needs one to replace
+    inspector = inspect(engine)
+    for table_name in BUS_TABLES:
+        if not inspector.has_table(table_name):
+            bare_table(table_name, table_name).create(engine)
+
+    with engine.begin() as connection:
+        connection.exec_driver_sql(f'DROP MATERIALIZED VIEW IF EXISTS "{SEGMENT_VIEW}{STAGING_SUFFIX}"')
+        for table_name in reversed(BUS_TABLES):
+            connection.exec_driver_sql(f'DROP TABLE IF EXISTS "{table_name}{STAGING_SUFFIX}"')
+
+        renames = []
+        cursor = connection.connection.dbapi_connection.cursor()
+        for table_name in BUS_TABLES:
+            staging_name = table_name + STAGING_SUFFIX
+            bare_table(table_name, staging_name).create(connection)
+            copy_dataframe(cursor, staging_name, tables[table_name])
+            # Keys and indexes are built after the load, in one pass over the data
+            with stage("build keys", table=staging_name):
+                for create, rename in staging_keys(table_name):
+                    connection.exec_driver_sql(create)
+                    renames.append(rename)
+                connection.exec_driver_sql(f'ANALYZE "{staging_name}"')
+            print(f"Loaded {len(tables[table_name])} rows into {staging_name}")
+
+        # The view follows its staging tables through the rename
+        with stage("build segment view"):
+            connection.exec_driver_sql(segment_view_sql(STAGING_SUFFIX))
+            for index_name, unique, columns in SEGMENT_VIEW_INDEXES:
+                connection.exec_driver_sql(f'CREATE {unique} INDEX "{index_name}{STAGING_SUFFIX}" '
+                                           f'ON "{SEGMENT_VIEW}{STAGING_SUFFIX}" ({columns})')
+                renames.append(f'ALTER INDEX "{index_name}{STAGING_SUFFIX}" RENAME TO "{index_name}"')
+
+    with stage("swap tables"), engine.begin() as connection:
+        live_tables = ", ".join(f'"{table_name}"' for table_name in BUS_TABLES)
+        connection.exec_driver_sql(f'LOCK TABLE {live_tables} IN ACCESS EXCLUSIVE MODE')
+        connection.exec_driver_sql(f'DROP MATERIALIZED VIEW IF EXISTS "{SEGMENT_VIEW}"')
+        for table_name in BUS_TABLES:
+            connection.exec_driver_sql(f'ALTER TABLE "{table_name}" RENAME TO "{table_name}_old"')
+            connection.exec_driver_sql(f'ALTER TABLE "{table_name}{STAGING_SUFFIX}" RENAME TO "{table_name}"')
+        connection.exec_driver_sql(f'ALTER MATERIALIZED VIEW "{SEGMENT_VIEW}{STAGING_SUFFIX}" RENAME TO "{SEGMENT_VIEW}"')
+        # Plain DROP so a foreign key from an unrelated table aborts the swap instead of being dropped
+        connection.exec_driver_sql("DROP TABLE " + ", ".join(f'"{table_name}_old"' for table_name in BUS_TABLES))
+        for rename in renames:
+            connection.exec_driver_sql(rename)
+
+        ensure_fingerprint_table(connection)
+        connection.exec_driver_sql(f'DELETE FROM "{FINGERPRINT_TABLE}"')
+        copy_dataframe(connection.connection.dbapi_connection.cursor(), FINGERPRINT_TABLE, fingerprints)
+    print(f"Swapped {', '.join(BUS_TABLES)} and {SEGMENT_VIEW} into place")
+
+
+def history_table(table_name: str) -> Table:
+    '''
+    Partitioned history table of a schema table: its columns after a week_start column,
+    with its primary key and indexes led by the partition key so they hold per week
+    '''
+    table = BUS_SCHEMA[table_name]
+    name = table_name + HISTORY_SUFFIX
+    history = Table(name, MetaData(),
+                    Column("week_start", Date, nullable=False),
+                    *[Column(column.name, column.type, nullable=column.nullable) for column in table.columns],
+                    postgresql_partition_by=f'RANGE ("{HISTORY_PARTITION_KEYS[table_name]}")')
+    if table.primary_key.columns:
+        history.append_constraint(PrimaryKeyConstraint(
+            "week_start", *[column.name for column in table.primary_key.columns], name=f"{name}_pkey"))
+    # The timetable's indexes already lead with its partition key, the date
+    week_columns = ("week_start",) if HISTORY_PARTITION_KEYS[table_name] == "week_start" else ()
+    for index in table.indexes:
+        history.append_constraint(Index(index.name.replace(table_name, name, 1), *week_columns,
+                                        *[column.name for column in index.columns]))
+    return history
+
+
+HISTORY_SCHEMA = {table_name: history_table(table_name) for table_name in BUS_TABLES}
+
+
+def ensure_history_tables(connection):
+    for table in HISTORY_SCHEMA.values():
+        table.create(connection, checkfirst=True)
+    connection.exec_driver_sql(
+        f'CREATE TABLE IF NOT EXISTS "{VERSION_TABLE}" ('
+        f'week_start date NOT NULL, week_end date NOT NULL, workbook_sha256 text NOT NULL, '
+        f'workbook_name text, loaded_at timestamptz NOT NULL DEFAULT now(), retired_at timestamptz, '
+        f'PRIMARY KEY (week_start, workbook_sha256))')
+
+
+def schedule_weeks(dates) -> list:
+    '''
+    Monday of every week the dates fall in, in order
+    '''
+    days = pd.DatetimeIndex(pd.to_datetime(pd.Series(dates, dtype=object))).normalize()
+    return sorted({(day - timedelta(days=day.weekday())).date() for day in days})
+
+
+def partition_name(table_name: str, week_start: date, workbook_sha256: str) -> str:
+    return f"{table_name}{HISTORY_SUFFIX}_{week_start:%Y%m%d}_{workbook_sha256[:8]}"
+
+
+def partition_keys(table_name: str, partition: str) -> list:
+    '''
+    DDL giving a loaded partition the primary key and indexes of its parent,
+    so attaching it adopts them instead of building them under the lock
+    '''
+    history = HISTORY_SCHEMA[table_name]
+    keys = []
+    if history.primary_key.columns:
+        columns = ", ".join(f'"{column.name}"' for column in history.primary_key.columns)
+        keys.append(f'ALTER TABLE "{partition}" ADD CONSTRAINT "{partition}_pkey" PRIMARY KEY ({columns})')
+    for number, index in enumerate(sorted(history.indexes, key=lambda index: index.name)):
+        columns = ", ".join(f'"{column.name}"' for column in index.columns)
+        keys.append(f'CREATE INDEX "{partition}_idx{number}" ON "{partition}" ({columns})')
+    return keys
+
+
+def week_tables(tables: dict, week_start: date) -> dict:
+    '''
+    Rows of the generated tables for one week: its timetable rows, and the trips
+    and stops those rows refer to
+    '''
+    week_end = week_start + timedelta(weeks=1)
+    timetable = tables["bus_timetable"]
+    days = pd.to_datetime(timetable["date"])
+    timetable = timetable[(days >= pd.Timestamp(week_start)) & (days < pd.Timestamp(week_end))]
+    trips = tables["bus_trips"][tables["bus_trips"]["trip_id"].isin(timetable["trip_id"])]
+    schedule = tables["bus_schedule"][tables["bus_schedule"]["trip_id"].isin(trips["trip_id"])]
+    stops = tables["stops"][tables["stops"]["stop_id"].isin(schedule["stop_id"])]
+    return {"stops": stops, "bus_trips": trips, "bus_schedule": schedule, "bus_timetable": timetable}
+
+
+def record_schedule_history(engine, tables: dict, workbook_sha256: str, workbook_name: str = None,
+                            dates=None, keep_weeks: int = HISTORY_WEEKS):
+    '''
+    Keep every week of the generated tables in the history tables, tagged with the hash of
+    their workbook. dates are the calendar dates the workbook covers, the timetable's by
+    default, so a week without a single trip still replaces what was known about it.
+    Each week is loaded into new tables that are attached as partitions of that week:
+    earlier versions of the same weeks are detached and dropped, and so are weeks past
+    keep_weeks. Weeks the workbook does not cover are left alone, no history rows are
+    deleted or rewritten, and only the new weeks are written.
+    '''
+    weeks = schedule_weeks(tables["bus_timetable"]["date"] if dates is None else dates)
+    if not weeks:
+        print("The workbook covers no dates, nothing to keep in the history")
+        return
+    with engine.begin() as connection:
+        ensure_history_tables(connection)
+        versions = pd.read_sql(f'SELECT week_start, week_end, workbook_sha256 FROM "{VERSION_TABLE}" '
+                               f'WHERE retired_at IS NULL', connection)
+    loaded = set(zip(versions['week_start'], versions['workbook_sha256']))
+    skipped = [week_start for week_start in weeks if (week_start, workbook_sha256) in loaded]
+    weeks = [week_start for week_start in weeks if week_start not in skipped]
+    if skipped:
+        print(f"Weeks of {', '.join(map(str, skipped))} are already in the history, skipping them")
+    if not weeks:
+        return
+
+    partitions = {week_start: {table_name: partition_name(table_name, week_start, workbook_sha256)
+                               for table_name in BUS_TABLES} for week_start in weeks}
+    with engine.begin() as connection:
+        cursor = connection.connection.dbapi_connection.cursor()
+        for week_start, week_partitions in partitions.items():
+            week_end = week_start + timedelta(weeks=1)
+            week = week_tables(tables, week_start)
+            for table_name, partition in week_partitions.items():
+                history_name = table_name + HISTORY_SUFFIX
+                connection.exec_driver_sql(f'DROP TABLE IF EXISTS "{partition}"')
+                connection.exec_driver_sql(f'CREATE TABLE "{partition}" (LIKE "{history_name}")')
+                copy_dataframe(cursor, partition, week[table_name].assign(week_start=week_start))
+                with stage("build keys", table=partition):
+                    for create in partition_keys(table_name, partition):
+                        connection.exec_driver_sql(create)
+                    # Proves the bounds up front, so attaching skips scanning the partition
+                    key = HISTORY_PARTITION_KEYS[table_name]
+                    connection.exec_driver_sql(
+                        f'ALTER TABLE "{partition}" ADD CONSTRAINT "{partition}_bounds" '
+                        f'CHECK ("{key}" >= DATE \'{week_start}\' AND "{key}" < DATE \'{week_end}\')')
+                    connection.exec_driver_sql(f'ANALYZE "{partition}"')
+
+    # Versions of the weeks the workbook covers, and weeks that fell out of the window
+    horizon = max(weeks) - timedelta(weeks=keep_weeks)
+    replaced = pd.Series(False, index=versions.index)
+    for week_start in weeks:
+        replaced |= (versions['week_start'] < week_start + timedelta(weeks=1)) & (week_start < versions['week_end'])
+    retired = versions[replaced | (versions['week_end'] <= horizon)]
+    with stage("attach partitions"), engine.begin() as connection:
+        for old in retired.itertuples(index=False):
+            for table_name in reversed(BUS_TABLES):
+                old_partition = partition_name(table_name, old.week_start, old.workbook_sha256)
+                connection.exec_driver_sql(
+                    f'ALTER TABLE "{table_name}{HISTORY_SUFFIX}" DETACH PARTITION "{old_partition}"')
+                connection.exec_driver_sql(f'DROP TABLE "{old_partition}"')
+            connection.exec_driver_sql(
+                f'UPDATE "{VERSION_TABLE}" SET retired_at = now() WHERE week_start = %s AND workbook_sha256 = %s',
+                (old.week_start, old.workbook_sha256))
+
+        for week_start, week_partitions in partitions.items():
+            week_end = week_start + timedelta(weeks=1)
+            for table_name, partition in week_partitions.items():
+                connection.exec_driver_sql(
+                    f'ALTER TABLE "{table_name}{HISTORY_SUFFIX}" ATTACH PARTITION "{partition}" '
+                    f'FOR VALUES FROM (\'{week_start}\') TO (\'{week_end}\')')
+                connection.exec_driver_sql(f'ALTER TABLE "{partition}" DROP CONSTRAINT "{partition}_bounds"')
+                connection.exec_driver_sql(
+                    f'COMMENT ON TABLE "{partition}" IS \'workbook sha256 {workbook_sha256}\'')
+            connection.exec_driver_sql(
+                f'INSERT INTO "{VERSION_TABLE}" (week_start, week_end, workbook_sha256, workbook_name) '
+                f'VALUES (%s, %s, %s, %s) '
+                # A workbook re-uploaded for a week it covered before brings its retired version back
+                f'ON CONFLICT (week_start, workbook_sha256) DO UPDATE SET '
+                f'retired_at = NULL, loaded_at = now(), workbook_name = EXCLUDED.workbook_name',
+                (week_start, week_end, workbook_sha256, workbook_name))
+    print(f"Attached {len(weeks)} weeks from {weeks[0]} to the history, retired {len(retired)} earlier versions")
+
+
+def schedule_on(connection, day: date) -> pd.DataFrame:
+    '''
+    Stop times of every trip running on day, from the history. The week is resolved
+    first, so each history table is planned against that week's partition only.
+    '''
+    week = connection.exec_driver_sql(
+        f'SELECT week_start FROM "{VERSION_TABLE}" WHERE retired_at IS NULL AND week_start <= %s AND %s < week_end',
+        (day, day)).scalar()
+    if week is None:
+        return pd.DataFrame(columns=['trip_id', 'route', 'stop_sequence', 'stop_name', 'stop_time'])
+    return pd.read_sql(text(
+        'SELECT t.trip_id, r.route, s.stop_sequence, s.stop_name, s.stop_time '
+        'FROM "bus_timetable_history" t '
+        'JOIN "bus_trips_history" r ON r.week_start = :week AND r.trip_id = t.trip_id '
+        'JOIN "bus_schedule_history" s ON s.week_start = :week AND s.trip_id = t.trip_id '
+        'WHERE t.date = :day AND t.week_start = :week '
+        'ORDER BY t.trip_id, s.stop_sequence'), connection, params={'week': week, 'day': day})
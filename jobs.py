@@ -0,0 +1,129 @@
+import hashlib
+import threading
+import time
+import traceback
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from io import BytesIO
+
+from layout import WorkbookLayoutError
+from telemetry import pipeline_run, run_summary, stage
+from utils import (get_processed_workbook, processing_uploaded_file, publish_artifacts, read_workbook,
+                   reload_trip_queries, update_bus_schedule_database, upload_to_blob_storage)
+
+
+# One job at a time: jobs share the staging tables and replace each other's artifacts
+JOB_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="pipeline-job")
+JOB_HISTORY_SIZE = 20
+JOB_STAGES = ("validate workbook", "upload workbook", "generate artifacts", "update database", "publish artifacts", "reload trip queries")
+
+
+@dataclass
+class Job:
+    '''
+    One processed upload, updated by the worker thread as it goes
+    '''
+    job_id: str
+    filename: str
+    content_hash: str
+    status: str = "queued"
+    stage: str = None
+    stage_seconds: dict = field(default_factory=dict)
+    # Every traced stage of the run, see telemetry.run_summary
+    timings: list = field(default_factory=list)
+    error: str = None
+    submitted: float = field(default_factory=time.time)
+    finished: float = None
+    # Identical bytes were already processed, nothing ran
+    cached: bool = False
+
+    @property
+    def progress(self) -> float:
+        return len(self.stage_seconds) / len(JOB_STAGES)
+
+
+# Recent jobs of this process, oldest first
+_jobs = OrderedDict()
+_jobs_lock = threading.Lock()
+
+
+def workbook_hash(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def submit_upload(filename: str, data: bytes) -> tuple:
+    '''
+    Queue an uploaded workbook for processing, returning (job id, whether a new job was queued) right away.
+    Bytes that are already queued or running, or that are the published workbook, are not
+    processed again: the id of that job, or of a finished cached job, is returned instead.
+    An earlier workbook that has since been replaced is processed again, to revert to it.
+    '''
+    content_hash = workbook_hash(data)
+    processed = get_processed_workbook()
+    with _jobs_lock:
+        for job in reversed(_jobs.values()):
+            if job.content_hash == content_hash and job.status in ("queued", "running"):
+                return job.job_id, False
+
+        job = Job(job_id=uuid.uuid4().hex[:8], filename=filename, content_hash=content_hash)
+        if processed is not None and processed['sha256'] == content_hash:
+            job.status, job.cached, job.finished = "done", True, time.time()
+        _jobs[job.job_id] = job
+        while len(_jobs) > JOB_HISTORY_SIZE:
+            _jobs.popitem(last=False)
+    if job.cached:
+        return job.job_id, False
+    JOB_EXECUTOR.submit(run_job, job, data)
+    return job.job_id, True
+
+
+def recent_jobs() -> list:
+    with _jobs_lock:
+        return list(reversed(_jobs.values()))
+
+
+def get_job(job_id: str) -> Job:
+    with _jobs_lock:
+        return _jobs.get(job_id)
+
+
+def run_stage(job: Job, stage_name: str, func, *args, **kwargs):
+    job.stage = stage_name
+    with stage(stage_name, job=job.job_id) as record:
+        result = func(*args, **kwargs)
+    job.stage_seconds[stage_name] = record.seconds
+    return result
+
+
+def run_job(job: Job, data: bytes):
+    '''
+    The upload pipeline of main.py, stage by stage
+    '''
+    job.status = "running"
+    workbook_file = BytesIO(data)
+    processed_filename = job.filename.replace(" ", "_")
+    records = []
+    try:
+        with pipeline_run() as records:
+            # A malformed workbook fails here, before anything is uploaded or written to the database
+            workbook = run_stage(job, "validate workbook", read_workbook, workbook_file)
+            uploaded = run_stage(job, "upload workbook", upload_to_blob_storage, job.filename, workbook_file)
+            tables, uploads = run_stage(job, "generate artifacts", processing_uploaded_file, processed_filename,
+                                        workbook=workbook)
+            run_stage(job, "update database", update_bus_schedule_database, tables, workbook=uploaded,
+                      dates=workbook.calendar.dates)
+            # The manifest now records this workbook's hash, later uploads of the same bytes are skipped
+            run_stage(job, "publish artifacts", publish_artifacts, uploads, workbook=uploaded)
+            run_stage(job, "reload trip queries", reload_trip_queries)
+        job.status = "done"
+        job.stage = None
+    except Exception as e:
+        job.status = "failed"
+        # Layout errors list every problem cell for whoever fixes the workbook
+        job.error = str(e) if isinstance(e, WorkbookLayoutError) else f"{e!r}"
+        traceback.print_exc()
+    finally:
+        job.timings = run_summary(records)
+        job.finished = time.time()
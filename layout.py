@@ -0,0 +1,155 @@
+'''
+Declarative layout of the weekly schedule workbook. Every offset the parsers
+rely on lives here, and compile_layout() turns a layout into the column gathers
+the parsers slice each sheet with.
+
+Rows count from the first row under the header row pandas consumes, so row 0
+is spreadsheet row 2. Column spans are (start, stop) like a slice.
+'''
+from dataclasses import dataclass, replace
+from functools import lru_cache
+
+import numpy as np
+
+
+# Spreadsheet row of row 0 of a sheet read by pandas
+FIRST_DATA_ROW = 2
+DAY_ABBREVIATIONS = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')
+
+
+@dataclass(frozen=True)
+class RouteSheetLayout:
+    '''
+    A route sheet: a title block, then one row per stop with the outbound stops and
+    slot times on the left and the return ones on the right
+    '''
+    header_rows: int
+    outbound_stops: int
+    outbound_times: tuple
+    return_stops: int
+    return_times: tuple
+
+
+@dataclass(frozen=True)
+class CalendarLayout:
+    '''
+    The calendar sheet: a title block, then one row per (date, route code) with a
+    0/1 flag per slot of each direction
+    '''
+    header_rows: int
+    date: int
+    day: int
+    route: int
+    outbound_flags: tuple
+    return_flags: tuple
+    # Code of each route sheet with calendar rows, in trip_id order and in the order rows appear each day
+    route_codes: tuple
+    # Route sheets past route_codes have no rows of their own and run on this code's flags
+    shared_route: str
+
+
+@dataclass(frozen=True)
+class WorkbookLayout:
+    # Route sheets in trip_id order
+    route_sheets: tuple
+    route_sheet: RouteSheetLayout
+    calendar: CalendarLayout
+    # Position of the calendar among the sheets, the current week is the last sheet
+    calendar_sheet: int = -1
+
+    def with_routes(self, route_sheets: tuple, route_codes: tuple) -> "WorkbookLayout":
+        return replace(self, route_sheets=route_sheets,
+                       calendar=replace(self.calendar, route_codes=route_codes, shared_route=route_codes[0]))
+
+
+BUS_WORKBOOK = WorkbookLayout(
+    route_sheets=('Hai Ba Trung', 'Cau Giay', 'Tay Ho', 'Ha Dong', 'Ecopark'),
+    route_sheet=RouteSheetLayout(header_rows=3,
+                                 outbound_stops=0,
+                                 outbound_times=(1, 6),
+                                 return_stops=7,
+                                 return_times=(8, 14)),
+    calendar=CalendarLayout(header_rows=9,
+                            date=0,
+                            day=1,
+                            route=2,
+                            outbound_flags=(3, 8),
+                            return_flags=(8, 14),
+                            route_codes=('HBT', 'CG', 'TH', 'HD'),
+                            shared_route='HBT'),
+)
+
+
+@dataclass(frozen=True)
+class CompiledLayout:
+    '''
+    Gather plans of a layout: each sheet is converted to one object array, and
+    the columns are taken from it in a single fancy-indexing pass
+    '''
+    layout: WorkbookLayout
+    # Route sheet columns in the order outbound stop, outbound times, return stop, return times
+    route_columns: np.ndarray
+    outbound_slots: int
+    return_slots: int
+    # Calendar columns in the order date, day, route, outbound flags, return flags
+    calendar_columns: np.ndarray
+
+    @property
+    def route_width(self) -> int:
+        return int(self.route_columns.max()) + 1
+
+    @property
+    def calendar_width(self) -> int:
+        return int(self.calendar_columns.max()) + 1
+
+    def calendar_name(self, sheet_names: list) -> str:
+        return sheet_names[self.layout.calendar_sheet]
+
+
+def span(columns: tuple) -> np.ndarray:
+    return np.arange(*columns)
+
+
+@lru_cache(maxsize=None)
+def compile_layout(layout: WorkbookLayout = BUS_WORKBOOK) -> CompiledLayout:
+    route, calendar = layout.route_sheet, layout.calendar
+    outbound_slots, return_slots = len(span(route.outbound_times)), len(span(route.return_times))
+    if (len(span(calendar.outbound_flags)), len(span(calendar.return_flags))) != (outbound_slots, return_slots):
+        raise ValueError("The calendar needs one flag column per slot of the route sheets")
+    if len(calendar.route_codes) >= len(layout.route_sheets):
+        raise ValueError("The calendar codes leave no route sheet to follow the shared route")
+    if calendar.shared_route not in calendar.route_codes:
+        raise ValueError(f"Shared route {calendar.shared_route!r} is not a calendar route code")
+    return CompiledLayout(layout=layout,
+                          route_columns=np.r_[route.outbound_stops, span(route.outbound_times),
+                                              route.return_stops, span(route.return_times)],
+                          outbound_slots=outbound_slots,
+                          return_slots=return_slots,
+                          calendar_columns=np.r_[calendar.date, calendar.day, calendar.route,
+                                                 span(calendar.outbound_flags), span(calendar.return_flags)])
+
+
+def cell_name(row: int, column: int) -> str:
+    '''
+    Spreadsheet name of a cell, e.g. B5, for error messages
+    '''
+    letters = ""
+    column += 1
+    while column:
+        column, remainder = divmod(column - 1, 26)
+        letters = chr(ord('A') + remainder) + letters
+    return f"{letters}{row + FIRST_DATA_ROW}"
+
+
+class WorkbookLayoutError(ValueError):
+    '''
+    The workbook does not match its layout. Carries every problem found, not just the first.
+    '''
+    # Problems listed in the message, the rest are only counted
+    MAX_LISTED = 20
+
+    def __init__(self, problems: list):
+        self.problems = problems
+        listed = "\n".join(f"- {problem}" for problem in problems[:self.MAX_LISTED])
+        more = f"\n... and {len(problems) - self.MAX_LISTED} more" if len(problems) > self.MAX_LISTED else ""
+        super().__init__(f"Workbook does not match the expected layout:\n{listed}{more}")
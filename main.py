@@ -1,5 +1,8 @@
+import time
+
 import streamlit as st
-from utils import upload_to_blob_storage, processing_uploaded_file, update_bus_schedule_database
+from jobs import JOB_STAGES, recent_jobs, submit_upload
+from telemetry import start_metrics_server
 
 
 # Define valid usernames and passwords
@@ -32,6 +35,7 @@ def logout():
     st.session_state["authenticated"] = False
     
 def main():
+    start_metrics_server()
     if "authenticated" not in st.session_state:
         st.session_state["authenticated"] = False
 
@@ -41,19 +45,47 @@ def main():
         st.sidebar.button("Logout", on_click=logout)
         st.title("Uploading weekly bus schedule")
         uploaded_file = st.file_uploader("Choose a file", type=["xlsx"])
-        if uploaded_file is not None:
-            with st.spinner("Processing..."):
-                # get file name
-                filename = uploaded_file.name
-                processed_filename = filename.replace(" ", "_")
-                # print(filename)
-
-                upload_to_blob_storage(filename=filename, uploaded_file=uploaded_file)
-
-                processing_uploaded_file(processed_filename)
-                
-                update_bus_schedule_database()
-                st.success(f"File '{filename}' uploaded successfully to container!")
+        if "submitted_files" not in st.session_state:
+            st.session_state["submitted_files"] = {}
+        # Reruns keep the uploaded file around, queue each upload only once
+        if uploaded_file is not None and uploaded_file.file_id not in st.session_state["submitted_files"]:
+            job_id, queued = submit_upload(uploaded_file.name, uploaded_file.getvalue())
+            st.session_state["submitted_files"][uploaded_file.file_id] = job_id
+            if queued:
+                st.info(f"File '{uploaded_file.name}' queued for processing as job {job_id}")
+            else:
+                st.info(f"File '{uploaded_file.name}' has the same content as job {job_id}, it is not processed again")
+        job_history()
+
+
+@st.fragment(run_every=1)
+def job_history():
+    '''
+    Progress of the running job and the outcome of recent ones, refreshed every second
+    '''
+    jobs = recent_jobs()
+    if not jobs:
+        return
+    st.subheader("Recent uploads")
+    for job in jobs:
+        elapsed = (job.finished or time.time()) - job.submitted
+        label = f"{job.job_id} · {job.filename} · {job.status} · {elapsed:.0f}s"
+        if job.status in ("queued", "running"):
+            st.progress(job.progress, text=f"{label} · {job.stage or 'waiting'}")
+        elif job.cached:
+            st.info(f"{label} · same content as the processed workbook, nothing to do")
+        elif job.status == "done":
+            st.success(f"{label} · uploaded successfully to container!")
+        else:
+            st.error(f"{label} · {job.error}")
+        with st.expander(f"Stages of {job.job_id}"):
+            for stage in JOB_STAGES:
+                seconds = job.stage_seconds.get(stage)
+                state = f"{seconds:.2f}s" if seconds is not None else ("running" if stage == job.stage else "")
+                st.text(f"{stage:<22} {state}")
+            if job.timings:
+                st.caption("Timing summary")
+                st.dataframe(job.timings, hide_index=True)
 
 
 if __name__ == "__main__":
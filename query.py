@@ -0,0 +1,112 @@
+import threading
+from datetime import date, time
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from segments import clock
+from stops import canonical_stop_name, stop_aliases
+
+
+def time_seconds(column: pa.ChunkedArray) -> np.ndarray:
+    return column.cast(pa.time64("ns")).cast(pa.int64()).to_numpy() // 1_000_000_000
+
+
+class TripIndex:
+    '''
+    Read-only index over the typed tables of one workbook.
+    Every (pickup, dropoff) pair served by a trip owns a slice of departures sorted by
+    time, and a date x trip_id bitmap tells which trips run on a date.
+    '''
+    def __init__(self, tables: dict):
+        self.aliases = stop_aliases()
+        stops = tables["stops.parquet"].to_pandas()
+        self.stop_names = dict(zip(stops['stop_id'], stops['stop_name'].astype(str)))
+        self.stop_ids = {stop_name: stop_id for stop_id, stop_name in self.stop_names.items()}
+
+        trips = tables["bus_trips.parquet"]
+        self.routes = dict(zip(trips['trip_id'].to_numpy(), trips['route'].cast(pa.string()).to_pylist()))
+
+        schedule = tables["bus_schedule.parquet"]
+        stop_times = pd.DataFrame({'trip_id': schedule['trip_id'].to_numpy(),
+                                   'stop_sequence': schedule['stop_sequence'].to_numpy(),
+                                   'stop_id': schedule['stop_id'].to_numpy(),
+                                   'seconds': time_seconds(schedule['stop_time'])})
+        # Every later stop of the same trip is a dropoff of every earlier one
+        pairs = stop_times.merge(stop_times, on='trip_id', suffixes=('_pickup', '_dropoff'))
+        pairs = pairs[pairs['stop_sequence_pickup'] < pairs['stop_sequence_dropoff']]
+        pairs = pairs.sort_values(['stop_id_pickup', 'stop_id_dropoff', 'seconds_pickup', 'trip_id'])
+        self.departures = pairs['seconds_pickup'].to_numpy()
+        self.arrivals = pairs['seconds_dropoff'].to_numpy()
+        self.trip_ids = pairs['trip_id'].to_numpy()
+
+        keys = pairs[['stop_id_pickup', 'stop_id_dropoff']].to_numpy()
+        starts = np.flatnonzero(np.r_[True, (keys[1:] != keys[:-1]).any(axis=1)]) if len(keys) else np.array([], dtype=int)
+        ends = np.r_[starts[1:], len(keys)]
+        self.pairs = {(int(keys[start, 0]), int(keys[start, 1])): (start, end) for start, end in zip(starts, ends)}
+
+        timetable = tables["bus_timetable.parquet"]
+        dates = timetable['date'].cast(pa.date32()).to_numpy()
+        self.dates, date_rows = np.unique(dates, return_inverse=True)
+        self.active = np.zeros((len(self.dates), int(self.trip_ids.max(initial=0)) + 1), dtype=bool)
+        trip_ids = timetable['trip_id'].to_numpy()
+        in_range = trip_ids < self.active.shape[1]
+        self.active[date_rows[in_range], trip_ids[in_range]] = True
+
+    def stop_id(self, stop_name: str) -> int:
+        '''
+        Id of a stop by any spelling the alias table understands
+        '''
+        stop_id = self.stop_ids.get(canonical_stop_name(stop_name, self.aliases))
+        if stop_id is None:
+            raise KeyError(f"Unknown stop {stop_name!r}")
+        return stop_id
+
+    def departures_between(self, pickup: str, dropoff: str, day: date, after: time = time(0), limit: int = None) -> list:
+        '''
+        Trips from pickup to dropoff running on day and leaving at or after after, earliest first
+        '''
+        span = self.pairs.get((self.stop_id(pickup), self.stop_id(dropoff)))
+        date_row = np.searchsorted(self.dates, np.datetime64(day, 'D'))
+        if span is None or date_row == len(self.dates) or self.dates[date_row] != np.datetime64(day, 'D'):
+            return []
+        start, end = span
+        start += np.searchsorted(self.departures[start:end], after.hour * 3600 + after.minute * 60 + after.second)
+        hits = start + np.flatnonzero(self.active[date_row, self.trip_ids[start:end]])
+        if limit is not None:
+            hits = hits[:limit]
+        return [{'trip_id': int(self.trip_ids[hit]),
+                 'route': self.routes.get(self.trip_ids[hit]),
+                 'pickup': self.stop_names[self.stop_id(pickup)],
+                 'dropoff': self.stop_names[self.stop_id(dropoff)],
+                 'date': day.isoformat(),
+                 'departure_time': clock(int(self.departures[hit])),
+                 'arrival_time': clock(int(self.arrivals[hit]))} for hit in hits]
+
+    def next_departure(self, pickup: str, dropoff: str, day: date, after: time) -> dict:
+        departures = self.departures_between(pickup, dropoff, day, after, limit=1)
+        return departures[0] if departures else None
+
+    def day_schedule(self, pickup: str, dropoff: str, day: date) -> list:
+        return self.departures_between(pickup, dropoff, day)
+
+
+# The index queries are answered from, replaced as a whole on reload
+_trip_index = None
+_reload_lock = threading.Lock()
+
+
+def load_trip_index(tables: dict) -> TripIndex:
+    '''
+    Build an index from the typed tables and swap it in. Queries already running
+    keep the index they started with.
+    '''
+    global _trip_index
+    with _reload_lock:
+        _trip_index = TripIndex(tables)
+    return _trip_index
+
+
+def current_trip_index() -> TripIndex:
+    return _trip_index
@@ -0,0 +1,160 @@
+from dataclasses import dataclass
+from typing import Iterator
+
+import numpy as np
+import pandas as pd
+
+from stops import canonical_stop_name, stop_aliases
+from workbook import to_time
+
+
+# Slots of the widest direction, return trips run one more slot than outbound ones
+GRID_SLOTS = 6
+# Slots StartingTime.csv carries for both directions
+STARTING_TIME_SLOTS = 5
+# Seconds of a slot a direction does not run
+NO_SLOT = -1
+
+
+def clock(seconds: int) -> str:
+    return f"{seconds // 3600:02d}:{seconds % 3600 // 60:02d}"
+
+
+def clock_seconds(values: pd.Series) -> np.ndarray:
+    # "HH:MM" text from the CSV or datetime.time from the typed table, empty when the slot does not run
+    times = [None if pd.isna(value) else to_time(value) for value in values]
+    return np.array([NO_SLOT if t is None else t.hour * 3600 + t.minute * 60 for t in times], dtype=np.int32)
+
+
+@dataclass
+class StopTimeGrid:
+    '''
+    Stop times of one direction of a route: one row per stop in travel order and
+    one column per slot, in seconds since midnight. Any two stops of the grid make
+    a segment, so segments are derived on demand instead of being stored.
+    '''
+    route_name: str
+    direction: str
+    stop_ids: np.ndarray
+    stop_names: np.ndarray
+    seconds: np.ndarray
+
+    def segments(self, pickup_rows: np.ndarray = None, dropoff_rows: np.ndarray = None) -> Iterator[dict]:
+        '''
+        Segments from every pickup row to every later dropoff row, one per running slot
+        '''
+        n_stops = len(self.stop_ids)
+        pickup_rows = np.arange(n_stops) if pickup_rows is None else pickup_rows
+        dropoff_rows = np.arange(n_stops) if dropoff_rows is None else dropoff_rows
+        for i in pickup_rows:
+            for j in dropoff_rows[dropoff_rows > i]:
+                for slot in np.flatnonzero((self.seconds[i] != NO_SLOT) & (self.seconds[j] != NO_SLOT)):
+                    yield {'route_name': self.route_name,
+                           'direction': self.direction,
+                           'slot': int(slot) + 1,
+                           'pickup_point': self.stop_names[i],
+                           'dropoff_point': self.stop_names[j],
+                           'departure_time': clock(int(self.seconds[i, slot])),
+                           'arrival_time': clock(int(self.seconds[j, slot]))}
+
+
+def grid_seconds(times: np.ndarray) -> np.ndarray:
+    seconds = np.full((len(times), GRID_SLOTS), NO_SLOT, dtype=np.int32)
+    for row, stop_times in enumerate(times):
+        seconds[row, :len(stop_times)] = [t.hour * 3600 + t.minute * 60 for t in stop_times]
+    return seconds
+
+
+def stop_time_grids(workbook) -> list:
+    '''
+    Outbound then return grid of every route of a parsed workbook
+    '''
+    grids = []
+    for route_name, route in workbook.routes.items():
+        for direction, stops, times in (('outbound', route.outbound_stops, route.outbound_times),
+                                        ('return', route.return_stops, route.return_times)):
+            grids.append(StopTimeGrid(route_name=route_name.title(),
+                                      direction=direction,
+                                      stop_ids=workbook.stops.stop_ids(stops),
+                                      stop_names=workbook.stops.stop_names(stops),
+                                      seconds=grid_seconds(times)))
+    return grids
+
+
+def grids_table(grids: list) -> pd.DataFrame:
+    '''
+    The grids as route_stop_times.csv, one row per stop of each direction
+    '''
+    parts = []
+    for grid in grids:
+        part = pd.DataFrame({'route_name': grid.route_name,
+                             'direction': grid.direction,
+                             'stop_sequence': np.arange(1, len(grid.stop_ids) + 1),
+                             'stop_id': grid.stop_ids,
+                             'stop_name': grid.stop_names})
+        for slot in range(GRID_SLOTS):
+            part[f'slot{slot + 1}'] = [clock(int(seconds)) if seconds != NO_SLOT else None
+                                       for seconds in grid.seconds[:, slot]]
+        parts.append(part)
+    return pd.concat(parts, ignore_index=True)
+
+
+def grids_from_table(df: pd.DataFrame) -> list:
+    '''
+    Grids of a route_stop_times.csv table, read back from the artifact store
+    '''
+    grids = []
+    for (route_name, direction), rows in df.groupby(['route_name', 'direction'], sort=False):
+        rows = rows.sort_values('stop_sequence')
+        grids.append(StopTimeGrid(route_name=route_name,
+                                  direction=direction,
+                                  stop_ids=rows['stop_id'].to_numpy(),
+                                  stop_names=rows['stop_name'].to_numpy(dtype=object),
+                                  seconds=np.column_stack([clock_seconds(rows[f'slot{slot}'])
+                                                           for slot in range(1, GRID_SLOTS + 1)])))
+    return grids
+
+
+def iter_segments(grids: list, pickup: str = None, dropoff: str = None, route_name: str = None,
+                  direction: str = None, aliases: tuple = None) -> Iterator[dict]:
+    '''
+    Lazily yield the pickup -> dropoff segments of the grids with their real departure
+    and arrival times. Each filter left as None matches everything, stop names are
+    matched by any spelling the alias table understands.
+    '''
+    aliases = stop_aliases() if aliases is None else aliases
+    pickup = None if pickup is None else canonical_stop_name(pickup, aliases)
+    dropoff = None if dropoff is None else canonical_stop_name(dropoff, aliases)
+    for grid in grids:
+        if (route_name is not None and grid.route_name != route_name) or \
+                (direction is not None and grid.direction != direction):
+            continue
+        pickup_rows = None if pickup is None else np.flatnonzero(grid.stop_names == pickup)
+        dropoff_rows = None if dropoff is None else np.flatnonzero(grid.stop_names == dropoff)
+        yield from grid.segments(pickup_rows, dropoff_rows)
+
+
+def starting_time_table(grids: list) -> pd.DataFrame:
+    '''
+    StartingTime.csv: every (pickup, dropoff) pair of each grid with the pickup's
+    first five slot times. Grows with stops squared, only built when exported.
+    '''
+    parts = []
+    for grid in grids:
+        # Row-major upper triangle: pickup i, then every later stop j > i as dropoff
+        pickup_idx, dropoff_idx = np.triu_indices(len(grid.stop_names), k=1)
+        part = {'route_name': np.full(len(pickup_idx), grid.route_name, dtype=object),
+                'pickup_point': grid.stop_names[pickup_idx],
+                'dropoff_point': grid.stop_names[dropoff_idx],
+                'date': None}
+        # Format once per stop, then gather by pair index
+        slot_times = np.array([[clock(int(seconds)) for seconds in row[:STARTING_TIME_SLOTS]]
+                               for row in grid.seconds], dtype=object).reshape(len(grid.stop_names),
+                                                                               STARTING_TIME_SLOTS)
+        for slot in range(STARTING_TIME_SLOTS):
+            part[f'slot{slot + 1}'] = slot_times[pickup_idx, slot]
+        parts.append(pd.DataFrame(part))
+    df = pd.concat(parts, ignore_index=True)
+    # Only five slots are exported for both directions, slot6 is kept for the CSV layout
+    df['slot6'] = None
+    return df
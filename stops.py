@@ -0,0 +1,85 @@
+import csv
+import os
+
+import numpy as np
+import pandas as pd
+
+
+# Stop cells containing a pattern are that canonical stop, patterns are checked in order.
+# STOP_ALIASES_FILE points at a CSV with pattern,stop_name rows replacing this table.
+STOP_ALIASES = (('buv', 'BUV Campus'),
+                ('aeon', 'AEON Mall Long Bien'),
+                ('le dai hanh', '51 Le Dai Hanh'))
+
+
+def load_aliases(path: str) -> tuple:
+    with open(path, newline='', encoding='utf-8') as f:
+        return tuple((row['pattern'].casefold(), row['stop_name']) for row in csv.DictReader(f))
+
+
+def stop_aliases() -> tuple:
+    path = os.getenv("STOP_ALIASES_FILE")
+    return load_aliases(path) if path else STOP_ALIASES
+
+
+def canonical_stop_name(cell, aliases: tuple = STOP_ALIASES) -> str:
+    '''
+    Canonical name of a raw stop cell. Whitespace is collapsed first,
+    so "Times City " and "Times City" are the same stop.
+    '''
+    text = " ".join(str(cell).split())
+    folded = text.casefold()
+    for pattern, stop_name in aliases:
+        if pattern in folded:
+            return stop_name
+    return text.title()
+
+
+class StopRegistry:
+    '''
+    Interned stops of one workbook. Every distinct cell text is resolved once.
+    Canonical stops keep the id known_ids gives them, the registry of every
+    earlier workbook, so a stop_id means the same stop from week to week.
+    Stops seen for the first time are numbered on from the highest known id.
+    '''
+    def __init__(self, aliases: tuple = None, known_ids: dict = None):
+        self.aliases = stop_aliases() if aliases is None else aliases
+        # Canonical name -> stop_id and back, known stops included
+        self.ids = dict(known_ids or {})
+        self.names = {stop_id: stop_name for stop_name, stop_id in self.ids.items()}
+        # Stops of this workbook, in order of first appearance
+        self.used = {}
+        self.cells = {}
+
+    def intern(self, cell) -> int:
+        stop_id = self.cells.get(cell)
+        if stop_id is None:
+            stop_name = canonical_stop_name(cell, self.aliases)
+            stop_id = self.ids.get(stop_name)
+            if stop_id is None:
+                stop_id = self.ids[stop_name] = max(self.names, default=0) + 1
+                self.names[stop_id] = stop_name
+            self.used[stop_id] = stop_name
+            self.cells[cell] = stop_id
+        return stop_id
+
+    def stop_ids(self, cells: np.ndarray) -> np.ndarray:
+        # Resolve each distinct cell, then gather back to every cell at once
+        codes, uniques = pd.factorize(np.asarray(cells, dtype=object))
+        return np.array([self.intern(cell) for cell in uniques], dtype=np.int64)[codes]
+
+    def stop_names(self, cells: np.ndarray) -> np.ndarray:
+        codes, uniques = pd.factorize(np.asarray(cells, dtype=object))
+        return np.array([self.names[self.intern(cell)] for cell in uniques], dtype=object)[codes]
+
+    def stops_table(self) -> pd.DataFrame:
+        # Stops of this workbook only, by id
+        stop_ids = sorted(self.used)
+        return pd.DataFrame({'stop_id': np.array(stop_ids, dtype=np.int64),
+                             'stop_name': [self.used[stop_id] for stop_id in stop_ids]})
+
+    def registry_table(self) -> pd.DataFrame:
+        # Every stop ever given an id, to seed the registry of the next workbook
+        stop_ids = sorted(self.names)
+        return pd.DataFrame({'stop_id': np.array(stop_ids, dtype=np.int64),
+                             'stop_name': [self.names[stop_id] for stop_id in stop_ids]})
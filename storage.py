@@ -0,0 +1,223 @@
+import base64
+import os
+import uuid
+
+from azure.core import MatchConditions
+from azure.core.exceptions import ResourceNotFoundError, ResourceNotModifiedError
+from azure.storage.blob import BlobBlock, ContainerClient, ContentSettings
+
+
+# Old blobs are deleted this many per batch request
+BLOB_BATCH_SIZE = 256
+PARTIAL_PREFIX = ".partial-"
+
+
+class ArtifactStore:
+    '''
+    Where the workbook and the generated artifacts live.
+    Uploads are staged first and only become visible when their commit function is called.
+    Every committed object has an ETag that changes whenever its content is replaced.
+    '''
+    def list_names(self, prefix: str = "") -> list:
+        raise NotImplementedError
+
+    def download(self, name: str) -> bytes:
+        raise NotImplementedError
+
+    def download_if_changed(self, name: str, etag: str = None) -> tuple:
+        '''
+        Conditional download: (None, etag) when the object still has etag, (data, its etag) otherwise.
+        Raises FileNotFoundError when there is no such object.
+        '''
+        raise NotImplementedError
+
+    def stage(self, name: str, chunks, content_type: str = None, content_encoding: str = None):
+        '''
+        Upload the chunks without publishing them, returning a function that publishes
+        them and returns their ETag. Stores with object metadata record the content type
+        and encoding, readers of the others recognise gzip by its magic bytes.
+        '''
+        raise NotImplementedError
+
+    def delete(self, names: list):
+        raise NotImplementedError
+
+    def upload(self, name: str, chunks, content_type: str = None, content_encoding: str = None) -> str:
+        return self.stage(name, chunks, content_type, content_encoding)()
+
+
+class AzureBlobStore(ArtifactStore):
+    def __init__(self, container_client: ContainerClient):
+        self.container_client = container_client
+
+    def __str__(self):
+        return f"Blob Storage {self.container_client.container_name}"
+
+    def list_names(self, prefix: str = "") -> list:
+        return [blob.name for blob in self.container_client.list_blobs(name_starts_with=prefix or None)]
+
+    def download(self, name: str) -> bytes:
+        return self.container_client.get_blob_client(name).download_blob().readall()
+
+    def download_if_changed(self, name: str, etag: str = None) -> tuple:
+        # If-None-Match: an unchanged blob answers 304 without a body
+        try:
+            if etag is None:
+                blob = self.container_client.get_blob_client(name).download_blob()
+            else:
+                blob = self.container_client.get_blob_client(name).download_blob(
+                    etag=etag, match_condition=MatchConditions.IfModified)
+        except ResourceNotModifiedError:
+            return None, etag
+        except ResourceNotFoundError:
+            raise FileNotFoundError(name)
+        return blob.readall(), blob.properties.etag
+
+    def stage(self, name: str, chunks, content_type: str = None, content_encoding: str = None):
+        # Uncommitted blocks are invisible to readers until the block list is committed
+        blob_client = self.container_client.get_blob_client(name)
+        block_list = []
+        for chunk in chunks:
+            block_id = base64.b64encode(uuid.uuid4().bytes).decode()
+            blob_client.stage_block(block_id, chunk)
+            block_list.append(BlobBlock(block_id=block_id))
+        content_settings = ContentSettings(content_type=content_type, content_encoding=content_encoding)
+        return lambda: blob_client.commit_block_list(block_list, content_settings=content_settings)['etag']
+
+    def delete(self, names: list):
+        # Batch requests instead of one request per blob
+        for start in range(0, len(names), BLOB_BATCH_SIZE):
+            self.container_client.delete_blobs(*names[start:start + BLOB_BATCH_SIZE])
+
+
+class LocalFileStore(ArtifactStore):
+    def __init__(self, root: str):
+        self.root = os.path.abspath(root)
+        os.makedirs(self.root, exist_ok=True)
+
+    def __str__(self):
+        return f"local directory {self.root}"
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.root, *name.split("/"))
+
+    def list_names(self, prefix: str = "") -> list:
+        names = []
+        for directory, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                if filename.startswith(PARTIAL_PREFIX):
+                    continue
+                name = os.path.relpath(os.path.join(directory, filename), self.root).replace(os.sep, "/")
+                if name.startswith(prefix):
+                    names.append(name)
+        return sorted(names)
+
+    def download(self, name: str) -> bytes:
+        with open(self.path(name), "rb") as f:
+            return f.read()
+
+    def etag(self, name: str) -> str:
+        stat = os.stat(self.path(name))
+        return f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+
+    def download_if_changed(self, name: str, etag: str = None) -> tuple:
+        current = self.etag(name)
+        if current == etag:
+            return None, etag
+        return self.download(name), current
+
+    def stage(self, name: str, chunks, content_type: str = None, content_encoding: str = None):
+        # Write next to the target, then rename it into place atomically
+        path = self.path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        partial_path = os.path.join(os.path.dirname(path), f"{PARTIAL_PREFIX}{uuid.uuid4().hex}")
+        with open(partial_path, "wb") as f:
+            for chunk in chunks:
+                f.write(chunk)
+
+        def commit():
+            os.replace(partial_path, path)
+            return self.etag(name)
+        return commit
+
+    def delete(self, names: list):
+        for name in names:
+            os.remove(self.path(name))
+
+
+class MemoryStore(ArtifactStore):
+    def __init__(self):
+        self.blobs = {}
+        self.etags = {}
+
+    def __str__(self):
+        return "in-memory store"
+
+    def list_names(self, prefix: str = "") -> list:
+        return sorted(name for name in self.blobs if name.startswith(prefix))
+
+    def download(self, name: str) -> bytes:
+        return self.blobs[name]
+
+    def download_if_changed(self, name: str, etag: str = None) -> tuple:
+        if name not in self.blobs:
+            raise FileNotFoundError(name)
+        if self.etags[name] == etag:
+            return None, etag
+        return self.blobs[name], self.etags[name]
+
+    def stage(self, name: str, chunks, content_type: str = None, content_encoding: str = None):
+        data = b"".join(bytes(chunk) for chunk in chunks)
+
+        def commit():
+            self.blobs[name], self.etags[name] = data, f'"{uuid.uuid4().hex}"'
+            return self.etags[name]
+        return commit
+
+    def delete(self, names: list):
+        for name in names:
+            del self.blobs[name]
+            del self.etags[name]
+
+
+class DiskCache:
+    '''
+    Local copies of store objects, revalidated with conditional downloads. Each copy is one
+    file holding its ETag on the first line, replaced atomically so a copy and its ETag
+    always belong together.
+    '''
+    def __init__(self, store: ArtifactStore, root: str):
+        self.store = store
+        self.root = os.path.abspath(root)
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.root, *name.split("/"))
+
+    def cached(self, name: str) -> tuple:
+        try:
+            with open(self.path(name), "rb") as f:
+                etag, data = f.read().split(b"\n", 1)
+        except (FileNotFoundError, ValueError):
+            return None, None
+        return data, etag.decode()
+
+    def read(self, name: str, etag: str = None) -> bytes:
+        '''
+        Content of name. A copy with the given etag, e.g. from the manifest, is returned
+        without asking the store, any other copy is revalidated.
+        '''
+        data, cached_etag = self.cached(name)
+        if data is not None and etag is not None and cached_etag == etag:
+            return data
+        fresh, fresh_etag = self.store.download_if_changed(name, cached_etag if data is not None else None)
+        if fresh is None:
+            return data
+
+        path = self.path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        partial_path = os.path.join(os.path.dirname(path), f"{PARTIAL_PREFIX}{uuid.uuid4().hex}")
+        with open(partial_path, "wb") as f:
+            f.write(fresh_etag.encode() + b"\n")
+            f.write(fresh)
+        os.replace(partial_path, path)
+        return fresh
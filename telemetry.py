@@ -0,0 +1,156 @@
+import contextvars
+import os
+import time
+from contextlib import contextmanager, nullcontext
+from functools import lru_cache
+
+try:
+    from opentelemetry import trace
+except ImportError:
+    trace = None
+try:
+    import prometheus_client
+except ImportError:
+    prometheus_client = None
+
+
+# Spans go to OTEL_EXPORTER: console for a local run, otlp for a collector
+# (configured through the standard OTEL_EXPORTER_OTLP_* variables), nowhere when unset.
+# Prometheus metrics are served on PROMETHEUS_PORT when it is set, by the process
+# that calls start_metrics_server(): the Streamlit page, the API or the batch parent.
+OTEL_EXPORTERS = ('console', 'otlp')
+SERVICE_NAME = "bus-schedule-ingestion"
+
+if prometheus_client is not None:
+    STAGE_SECONDS = prometheus_client.Histogram("bus_pipeline_stage_seconds", "Duration of a pipeline stage", ["stage"])
+    STAGE_ROWS = prometheus_client.Counter("bus_pipeline_stage_rows", "Rows a pipeline stage produced or moved", ["stage"])
+    STAGE_BYTES = prometheus_client.Counter("bus_pipeline_stage_bytes", "Bytes a pipeline stage read or wrote", ["stage"])
+    STAGE_FAILURES = prometheus_client.Counter("bus_pipeline_stage_failures", "Pipeline stages that raised", ["stage"])
+
+# Timings of the pipeline run the current thread works for
+_run = contextvars.ContextVar("pipeline_run", default=None)
+
+
+@lru_cache(maxsize=None)
+def start_metrics_server():
+    '''
+    Serve the metrics on PROMETHEUS_PORT, once per process. A port another process
+    already serves on is reported, it never fails the caller.
+    '''
+    port = os.getenv("PROMETHEUS_PORT")
+    if not port or prometheus_client is None:
+        return
+    try:
+        prometheus_client.start_http_server(int(port))
+    except OSError as e:
+        print(f"Not serving metrics on port {port}: {e!r}")
+
+
+@lru_cache(maxsize=None)
+def get_tracer():
+    '''
+    Process-wide tracer, set up from the environment on first use
+    '''
+    if trace is None:
+        return None
+    exporter_name = os.getenv("OTEL_EXPORTER")
+    if exporter_name:
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor, ConsoleSpanExporter
+
+        if exporter_name == 'console':
+            exporter = ConsoleSpanExporter()
+        elif exporter_name == 'otlp':
+            from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExporter
+            exporter = OTLPSpanExporter()
+        else:
+            raise ValueError(f"Unsupported span exporter {exporter_name!r}, expected one of {OTEL_EXPORTERS}")
+        provider = TracerProvider(resource=Resource.create({"service.name": SERVICE_NAME}))
+        provider.add_span_processor(BatchSpanProcessor(exporter))
+        trace.set_tracer_provider(provider)
+    return trace.get_tracer(SERVICE_NAME)
+
+
+class StageRecord:
+    '''
+    Measurements of one stage, the stage body fills in rows and bytes when it knows them
+    '''
+    def __init__(self, name: str, attributes: dict):
+        self.name = name
+        self.attributes = attributes
+        self.rows = None
+        self.bytes = None
+        self.seconds = None
+        self.started = None
+
+    @property
+    def label(self) -> str:
+        return " ".join([self.name, *map(str, self.attributes.values())])
+
+
+@contextmanager
+def stage(name: str, **attributes):
+    '''
+    Trace, meter and time a pipeline stage. Metrics are labelled by name only,
+    attributes go on the span and into the run summary.
+    '''
+    record = StageRecord(name, attributes)
+    tracer = get_tracer()
+    span_context = tracer.start_as_current_span(name, attributes=attributes) if tracer else nullcontext()
+    record.started = time.perf_counter()
+    with span_context as span:
+        try:
+            yield record
+        except Exception:
+            if prometheus_client is not None:
+                STAGE_FAILURES.labels(name).inc()
+            raise
+        finally:
+            record.seconds = time.perf_counter() - record.started
+            if span is not None:
+                for key, value in (('rows', record.rows), ('bytes', record.bytes)):
+                    if value is not None:
+                        span.set_attribute(key, value)
+            if prometheus_client is not None:
+                STAGE_SECONDS.labels(name).observe(record.seconds)
+                if record.rows is not None:
+                    STAGE_ROWS.labels(name).inc(record.rows)
+                if record.bytes is not None:
+                    STAGE_BYTES.labels(name).inc(record.bytes)
+            run = _run.get()
+            if run is not None:
+                run.append(record)
+
+
+@contextmanager
+def pipeline_run():
+    '''
+    Collect the records of every stage run under this context, including
+    stages submitted to executors with submit()
+    '''
+    records = []
+    token = _run.set(records)
+    try:
+        yield records
+    finally:
+        _run.reset(token)
+
+
+def submit(executor, func, *args):
+    # Carry the run and the parent span over to the executor thread
+    return executor.submit(contextvars.copy_context().run, func, *args)
+
+
+def run_summary(records: list) -> list:
+    '''
+    One row per stage in start order, for display
+    '''
+    if not records:
+        return []
+    run_start = min(record.started for record in records)
+    return [{'stage': record.label,
+             'start (s)': round(record.started - run_start, 3),
+             'seconds': round(record.seconds, 3),
+             'rows': record.rows,
+             'bytes': record.bytes} for record in sorted(records, key=lambda record: record.started)]
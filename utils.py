@@ -1,15 +1,33 @@
 import streamlit as st
+import requests
+from requests.adapters import HTTPAdapter
+from azure.core.pipeline.transport import RequestsTransport
 from azure.storage.blob import BlobServiceClient, ContainerClient
 
 import warnings
+import numpy as np
 import pandas as pd
-from io import BytesIO, StringIO
+from io import BytesIO
 from urllib.parse import quote
 
-from sqlalchemy import create_engine, MetaData, Table, Column, Integer, String, DateTime, ForeignKey, Text, text
-from sqlalchemy.orm import sessionmaker
+from artifacts import (CSV_CONTENT_TYPE, PARQUET_CONTENT_TYPE, csv_chunks, decompress, gzip_chunks, parquet_bytes,
+                       parquet_path, read_parquet, to_pandas, typed_table)
+from database import record_schedule_history, update_bus_tables
+from segments import grids_from_table, grids_table, starting_time_table, stop_time_grids
+from stops import StopRegistry
+from storage import ArtifactStore, AzureBlobStore, DiskCache, LocalFileStore, MemoryStore
+from telemetry import stage, submit
+from workbook import BusWorkbook, CalendarSheet, open_workbook, parse_workbook
+
+from sqlalchemy import URL, create_engine
 
 import os
+import json
+import hashlib
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from dotenv import load_dotenv, find_dotenv
 load_dotenv(find_dotenv("./application/.env"))
 
@@ -21,326 +39,499 @@ CONNECTION_STRING = os.getenv("BLOB_CONN_STRING")
 CONTAINER_NAME = os.getenv("BLOB_CONTAINER")
 BUS_SCHEDULE_FILE = os.getenv("BUS_SCHEDULE_FILE")
 
+# Artifact uploads run in the background while the pipeline keeps going
+UPLOAD_EXECUTOR = ThreadPoolExecutor(max_workers=4, thread_name_prefix="blob-upload")
+
+# Artifacts are uploaded as blocks of this size
+BLOB_BLOCK_SIZE = 4 * 1024 * 1024
+# CSV artifacts are stored gzip-compressed with CSV_GZIP=1, readers take either form
+CSV_GZIP = os.getenv("CSV_GZIP", "0") == "1"
+
+# Where the workbook and the artifacts are stored: azure, local or memory
+ARTIFACT_STORES = ('azure', 'local', 'memory')
+# Current workbook and published artifacts with their hashes and ETags, readers start here
+MANIFEST = "manifest.json"
+# Every stop_id ever given out, so stops keep their id from one workbook to the next
+STOP_REGISTRY = "stop_registry.csv"
+# Typed artifacts the database is loaded from
+DATABASE_ARTIFACTS = ("stops.parquet", "bus_schedule.parquet", "bus_timetable.parquet", "bus_trips.parquet")
+
+# Connection pool sizes of the shared clients, the blob pool covers every upload thread
+BLOB_POOL_SIZE = 8
+DB_POOL_SIZE = 5
+DB_MAX_OVERFLOW = 5
+# Azure closes idle connections, recycle pooled database connections before that happens
+DB_POOL_RECYCLE = 1800
+
+
+@lru_cache(maxsize=None)
+def get_blob_service_client() -> BlobServiceClient:
+    '''
+    Process-wide Blob Storage client, created on first use and shared by every
+    Streamlit rerun and session. Its HTTP session keeps connections alive.
+    '''
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=BLOB_POOL_SIZE, pool_maxsize=BLOB_POOL_SIZE)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    transport = RequestsTransport(session=session, session_owner=False)
+    return BlobServiceClient.from_connection_string(CONNECTION_STRING, transport=transport)
 
-def upload_to_blob_storage(filename, uploaded_file):
-    # read file content
-    file_contents = uploaded_file.read()
-    
+
+@lru_cache(maxsize=None)
+def get_container_client() -> ContainerClient:
+    return get_blob_service_client().get_container_client(CONTAINER_NAME)
+
+
+@lru_cache(maxsize=None)
+def get_engine():
+    '''
+    Process-wide SQLAlchemy engine with a long-lived connection pool
+    '''
+    # DATABASE_URL points the loader at another server, e.g. a local one for benchmarks
+    url = os.getenv("DATABASE_URL") or URL.create("postgresql+psycopg",
+                                                  username=os.getenv("PG_VECTOR_USER"),
+                                                  password=os.getenv("PG_VECTOR_PASSWORD"),
+                                                  host=os.getenv("PG_VECTOR_HOST"),
+                                                  port=5432,
+                                                  database=os.getenv("PGDATABASE2"))
+    return create_engine(url,
+                         pool_size=DB_POOL_SIZE,
+                         max_overflow=DB_MAX_OVERFLOW,
+                         pool_pre_ping=True,
+                         pool_recycle=DB_POOL_RECYCLE)
+
+
+@lru_cache(maxsize=None)
+def get_artifact_cache() -> DiskCache:
+    '''
+    Process-wide local copies of downloaded artifacts under ARTIFACT_CACHE_PATH
+    '''
+    root = os.getenv("ARTIFACT_CACHE_PATH") or os.path.join(tempfile.gettempdir(), "bus-schedule-artifacts")
+    return DiskCache(get_store(), root)
+
+
+@lru_cache(maxsize=None)
+def get_store() -> ArtifactStore:
+    '''
+    Process-wide artifact store, selected by ARTIFACT_STORE.
+    The local store keeps its files under ARTIFACT_STORE_PATH.
+    '''
+    backend = os.getenv("ARTIFACT_STORE", "azure")
+    if backend == 'azure':
+        return AzureBlobStore(get_container_client())
+    if backend == 'local':
+        return LocalFileStore(os.getenv("ARTIFACT_STORE_PATH", "artifacts"))
+    if backend == 'memory':
+        return MemoryStore()
+    raise ValueError(f"Unsupported artifact store {backend!r}, expected one of {ARTIFACT_STORES}")
+
+
+def metered_chunks(chunks, digest, record):
+    # Hash and count the bytes on their way to the store
+    record.bytes = 0
+    for chunk in chunks:
+        digest.update(chunk)
+        record.bytes += len(chunk)
+        yield chunk
+
+
+def blocks(chunks, block_size: int = BLOB_BLOCK_SIZE):
+    '''
+    Regroup chunks into upload blocks of block_size bytes, only the last one is shorter
+    '''
+    buffer = bytearray()
+    for chunk in chunks:
+        buffer += chunk
+        while len(buffer) >= block_size:
+            yield bytes(buffer[:block_size])
+            del buffer[:block_size]
+    if buffer:
+        yield bytes(buffer)
+
+
+def upload_to_blob_storage(filename, uploaded_file) -> dict:
+    '''
+    Stage the workbook without publishing it, returning its manifest entry with a commit
+    function. publish_artifacts commits it together with the artifacts generated from it
+    and deletes the previous workbook, so a job that fails leaves no workbook behind.
+    '''
     processed_filename = filename.replace(" ", "_")
-    # create BlobClient
-    blob_service_client = BlobServiceClient.from_connection_string(CONNECTION_STRING)
-    blob_client = blob_service_client.get_blob_client(container=CONTAINER_NAME,
-                                                      blob=processed_filename)
-
-    container_client = blob_service_client.get_container_client(container=CONTAINER_NAME)
-    blob_list = container_client.list_blobs()
-    # Delete only files with .xlsx extension before uploading a new file
-    for blob in blob_list:
-        if blob.name.endswith('.xlsx'):
-            container_client.delete_blob(blob.name)
-
-    # Upload file on Azure Blob Storage
-    blob_client.upload_blob(file_contents, overwrite=True)
+    store = get_store()
+
+    start = time.perf_counter()
+    with stage("upload workbook", file=processed_filename) as record:
+        # Stream the file up block by block instead of reading it into one buffer
+        uploaded_file.seek(0)
+        digest = hashlib.sha256()
+        commit = store.stage(processed_filename,
+                             metered_chunks(iter(lambda: uploaded_file.read(BLOB_BLOCK_SIZE), b""), digest, record))
+        # Rewind so the same bytes can be parsed without downloading them again
+        uploaded_file.seek(0)
     # time.sleep(10)  # wait 60s - cheating
     # st.success(f"File '{filename}' uploaded successfully to container!")
-    
-    # list all files in container
-    blob_list = container_client.list_blobs()
-    for blob in blob_list:
-        print(blob.name)
-
-
-def processing_uploaded_file(filename: str = None):
-    bus_calender_file, excel_filename = get_xlsx_file(filename)
-    print(f"Generating StartingTime.csv from {excel_filename}...")
-    generate_starting_time(bus_calender_file, "StartingTime.csv")
-    print(f"Generating bus_trips.csv from {excel_filename}...")
-    generate_bus_trips(bus_calender_file, "bus_trips.csv")
-    print(f"Generating bus_schedule.csv from {excel_filename}...")
-    generate_bus_schedule(bus_calender_file, "bus_schedule.csv")
-    print(f"Generating bus_timetable.csv from {excel_filename}...")
-    generate_bus_timetable(bus_calender_file, "bus_timetable.csv")
+    return {'name': processed_filename,
+            'sha256': digest.hexdigest(),
+            'commit': commit,
+            'bytes': record.bytes,
+            'seconds': time.perf_counter() - start}
+
+
+def stage_artifact(export_path: str, serialize, table, content_type: str, content_encoding: str = None) -> dict:
+    '''
+    Upload an artifact without publishing it. Nothing is visible to readers until
+    its commit function is called by publish_artifacts.
+    serialize yields the artifact in chunks, which are compressed and uploaded as they
+    come, so only about one block is held in memory at a time.
+    '''
+    start = time.perf_counter()
+    with stage("stage artifact", artifact=export_path) as record:
+        chunks = serialize(table)
+        if content_encoding == 'gzip':
+            chunks = gzip_chunks(chunks)
+        digest = hashlib.sha256()
+        commit = get_store().stage(export_path, blocks(metered_chunks(chunks, digest, record)),
+                                   content_type, content_encoding)
+    return {'commit': commit,
+            'bytes': record.bytes,
+            'sha256': digest.hexdigest(),
+            'seconds': time.perf_counter() - start}
+
+
+def parquet_chunks(table):
+    # Parquet is already compressed column by column, it goes up as a single buffer
+    yield parquet_bytes(table)
+
+
+def stage_artifacts(tables: dict, export_path: str, export_prefix: str = "") -> dict:
+    '''
+    Add the typed table of a generated table to tables, then stage the CSV for humans
+    and the Parquet file for machine consumers in the background, under export_prefix
+    '''
+    typed_path = parquet_path(export_path)
+    with stage("type table", artifact=export_path) as record:
+        tables[typed_path] = typed_table(export_path, tables[export_path])
+        record.rows = tables[typed_path].num_rows
+    return {export_prefix + export_path: submit(UPLOAD_EXECUTOR, stage_artifact, export_prefix + export_path, csv_chunks,
+                                                tables[export_path], CSV_CONTENT_TYPE, 'gzip' if CSV_GZIP else None),
+            export_prefix + typed_path: submit(UPLOAD_EXECUTOR, stage_artifact, export_prefix + typed_path, parquet_chunks,
+                                               tables[typed_path], PARQUET_CONTENT_TYPE)}
+
+
+def read_workbook(workbook_file, stop_ids: dict = None) -> BusWorkbook:
+    '''
+    Parse and validate uploaded workbook bytes, before anything is uploaded or loaded from them.
+    Stops are numbered against stop_ids, the published stop registry by default.
+    '''
+    workbook_file.seek(0)
+    with stage("open workbook"):
+        bus_calender_file = open_workbook(workbook_file)
+    return parse_workbook(bus_calender_file, known_stop_ids=get_stop_ids() if stop_ids is None else stop_ids)
+
+
+def processing_uploaded_file(filename: str = None, workbook_file=None, export_prefix: str = "",
+                             workbook: BusWorkbook = None, stop_ids: dict = None):
+    '''
+    Run the stage graph over the uploaded workbook.
+    Uses workbook when it was already parsed, parses workbook_file when the bytes are
+    already in hand, otherwise downloads filename.
+    Artifacts are staged under export_prefix, the published names when it is empty.
+    A workbook parsed here numbers its stops against stop_ids, the published registry by default.
+    Returns the generated and typed tables and the pending uploads of each artifact.
+    '''
+    excel_filename = filename
+    # Parse every sheet once, all generators share the same in-memory model
+    if workbook is None and workbook_file is not None:
+        workbook = read_workbook(workbook_file, stop_ids)
+    elif workbook is None:
+        bus_calender_file, excel_filename = get_xlsx_file(filename)
+        workbook = parse_workbook(bus_calender_file, known_stop_ids=get_stop_ids() if stop_ids is None else stop_ids)
+
+    tables = {}
+    uploads = {}
+    for export_path, (generator, inputs) in PIPELINE_STAGES.items():
+        print(f"Generating {export_path} from {excel_filename}...")
+        with stage("generate", artifact=export_path) as record:
+            tables[export_path] = generator(workbook, *[tables[name] for name in inputs])
+            record.rows = len(tables[export_path])
+        # Publishing is a side output, the next stage does not wait for it
+        uploads.update(stage_artifacts(tables, export_path, export_prefix))
     print("All files have been generated successfully!")
+    return tables, uploads
 
 
-def update_bus_schedule_database():
-    host = os.getenv("PG_VECTOR_HOST")
-    user = os.getenv("PG_VECTOR_USER")
-    password = os.getenv("PG_VECTOR_PASSWORD")
-    database = os.getenv("PGDATABASE2")
-    
-    # First, removing all data from the table
-    engine = create_engine(f'postgresql+psycopg://{user}:{password}@{host}:5432/{database}')
-    Session = sessionmaker(bind=engine)
-    session = Session()
-    
-    # Create a MetaData instance
-    metadata = MetaData()
-    # Reflect the tables
-    metadata.reflect(bind=engine)
+def commit_artifact(export_path: str, artifact: dict):
+    with stage("commit artifact", artifact=export_path) as record:
+        artifact['etag'] = artifact['commit']()
+        record.bytes = artifact['bytes']
+
+
+def publish_artifacts(uploads: dict, workbook: dict = None) -> dict:
+    '''
+    Wait for every staged artifact upload, then commit them all concurrently.
+    If any upload failed nothing is committed, so the previously published set stays intact.
+    With the staged workbook they were generated from, the workbook is committed along with
+    them, the manifest is switched over to the new set and the previous workbook deleted.
+    Returns the upload time of each artifact in seconds.
+    '''
+    staged = {}
+    failures = {}
+    for export_path, upload in uploads.items():
+        try:
+            staged[export_path] = upload.result()
+        except Exception as e:
+            failures[export_path] = e
+            print(f"Uploading {export_path} failed: {e!r}")
+    if failures:
+        raise RuntimeError(f"Artifacts not published, upload failed for {', '.join(failures)}")
+
+    # The workbook goes up with the artifacts generated from it
+    pending = dict(staged)
+    if workbook is not None:
+        pending[workbook['name']] = workbook
+    commits = {export_path: submit(UPLOAD_EXECUTOR, commit_artifact, export_path, artifact)
+               for export_path, artifact in pending.items()}
+    timings = {}
+    for export_path, commit in commits.items():
+        try:
+            commit.result()
+        except Exception as e:
+            failures[export_path] = e
+            print(f"Committing {export_path} failed: {e!r}")
+            continue
+        timings[export_path] = pending[export_path]['seconds']
+        print(f"{export_path} ({pending[export_path]['bytes']} bytes) uploaded to "
+              f"{get_store()} in {timings[export_path]:.2f}s.")
+    if failures:
+        raise RuntimeError(f"Artifacts partially published, commit failed for {', '.join(failures)}")
+    if workbook is not None:
+        write_manifest({key: workbook[key] for key in ('name', 'sha256', 'etag')}, {export_path: {key: artifact[key] for key in ('sha256', 'bytes', 'etag')}
+                                  for export_path, artifact in staged.items()})
+    return timings
+
+
+def write_manifest(workbook: dict, artifacts: dict):
+    store = get_store()
+    previous = get_manifest()
+    manifest = {'workbook': {**workbook, 'processed_at': time.strftime("%Y-%m-%dT%H:%M:%S%z")},
+                'artifacts': artifacts}
+    store.upload(MANIFEST, [json.dumps(manifest, indent=2).encode('utf-8')], "application/json")
+
+    # Keep only the new workbook. Before the first manifest the old ones have to be found by listing.
+    if previous is None:
+        old_workbooks = [name for name in store.list_names() if name.endswith('.xlsx')]
+    else:
+        old_workbooks = [previous['workbook']['name']]
+    store.delete([name for name in old_workbooks if name != workbook['name']])
+
+
+def reload_trip_queries():
+    '''
+    Ask the trip query API at TRIP_QUERY_URL, when one is configured, to load the published artifacts
+    '''
+    url = os.getenv("TRIP_QUERY_URL")
+    if not url:
+        return
     try:
-        # Truncate each table in reverse order to handle dependencies
-        for table in reversed(metadata.sorted_tables):
-            print(f"{table.name=}")
-            session.execute(text(f'TRUNCATE TABLE {table.name} CASCADE'))
-            print(f'Truncated table {table.name}')
-        session.commit()
-    finally:
-        session.close()
-    
-    # Định nghĩa các bảng
-    # bus_trips = Table('bus_trips', metadata,
-    #                 Column('trip_id', Integer, primary_key=True),
-    #                 Column('route', Text, nullable=False),
-    #                 Column('departure_district', Text, nullable=False),
-    #                 Column('arrival', Text, nullable=False),
-    #                 Column('departure_time', DateTime, nullable=False),
-    #                 Column('arrival_time', DateTime, nullable=False))
-
-    # bus_schedule = Table('bus_schedule', metadata,
-    #                     Column('trip_id', Integer, ForeignKey('bus_trips.trip_id'), primary_key=True),
-    #                     Column('stop_sequence', Integer, primary_key=True),
-    #                     Column('stop_name', Text),
-    #                     Column('stop_time', DateTime))
-
-    # bus_timetable = Table('bus_timetable', metadata,
-    #                     Column('day_of_week', Text, primary_key=True),
-    #                     Column('trip_id', Integer, ForeignKey('bus_trips.trip_id'), primary_key=True),
-    #                     Column('date', DateTime))
-    
-    # metadata.drop_all(engine)
+        requests.post(url.rstrip("/") + "/reload", timeout=30).raise_for_status()
+    except requests.RequestException as e:
+        # The artifacts are published either way, the API keeps answering from the previous week
+        print(f"Reloading the trip query API failed: {e!r}")
+
 
-    # Tạo các bảng trong cơ sở dữ liệu
-    metadata.create_all(engine)
+def update_bus_schedule_database(tables: dict = None, workbook: dict = None, dates=None):
+    '''
+    Load the tables into the live bus tables and keep their weeks in the schedule history.
+    workbook is the manifest entry of the workbook the tables came from, the published
+    one when the tables are read back from the store. dates are its calendar dates,
+    the weeks of the timetable when not given.
+    '''
+    engine = get_engine()
     
-    bus_schedule_df = get_csv_file("bus_schedule.csv")
-    bus_timetable_df = get_csv_file("bus_timetable.csv")
-    bus_trips_df = get_csv_file("bus_trips.csv")
+    if tables is None:
+        tables = get_published_parquet_files(DATABASE_ARTIFACTS)
+        workbook = get_processed_workbook()
+    # The typed tables already hold times and dates, nothing is parsed from text.
+    # The schema lives in database.BUS_SCHEMA.
+    stops_df = to_pandas(tables["stops.parquet"])
+    bus_schedule_df = to_pandas(tables["bus_schedule.parquet"])
+    bus_timetable_df = to_pandas(tables["bus_timetable.parquet"])
+    bus_trips_df = to_pandas(tables["bus_trips.parquet"])
     
     # Đổi tên các cột để khớp với tên cột trong cơ sở dữ liệu
-    bus_schedule_df.columns = ['trip_id', 'stop_sequence', 'stop_name', 'stop_time']
+    bus_schedule_df.columns = ['trip_id', 'stop_sequence', 'stop_id', 'stop_name', 'stop_time']
     bus_timetable_df.columns = ['day_of_week', 'trip_id', 'date']
     bus_trips_df.columns = ['trip_id', 'route', 'departure_district', 'arrival', 'departure_time', 'arrival_time']
     
-    # Đảm bảo các cột có định dạng đúng
-    bus_schedule_df['stop_time'] = pd.to_datetime(bus_schedule_df['stop_time'], format="%H:%M")
-    # bus_timetable_df['date'] = pd.to_datetime(bus_timetable_df['date'], format='%d/%m/%Y')
-    bus_timetable_df['date'] = pd.to_datetime(bus_timetable_df['date'], format='%m/%d/%Y')
-    bus_trips_df['departure_time'] = pd.to_datetime(bus_trips_df['departure_time'], format="%H:%M")
-    bus_trips_df['arrival_time'] = pd.to_datetime(bus_trips_df['arrival_time'], format="%H:%M")
-    
-    # Tải dữ liệu lên PostgreSQL
-    bus_trips_df.to_sql('bus_trips', engine, if_exists='append', index=False)
-    bus_schedule_df.to_sql('bus_schedule', engine, if_exists='append', index=False)
-    bus_timetable_df.to_sql('bus_timetable', engine, if_exists='append', index=False)
+    # Tải dữ liệu lên PostgreSQL: only the trips that changed since the last load
+    bus_tables = {'stops': stops_df,
+                  'bus_trips': bus_trips_df,
+                  'bus_schedule': bus_schedule_df,
+                  'bus_timetable': bus_timetable_df}
+    # History first: if it fails, the live tables stay on the published workbook
+    if workbook is not None:
+        record_schedule_history(engine, bus_tables, workbook['sha256'], workbook['name'], dates)
+    update_bus_tables(engine, bus_tables)
 
     print("Dữ liệu đã được tải lên PostgreSQL thành công!")
 
 
-def get_xlsx_file(filename: str = "StartingTime.xlsx"):
+class ArtifactMismatchError(RuntimeError):
+    '''
+    A downloaded artifact is not the one the manifest lists, e.g. a newer set was
+    published since the manifest was read, or an earlier publish stopped half way
+    '''
+
+
+def download_artifact(filename: str, etag: str = None, sha256: str = None) -> bytes:
     '''
-    Load the bus schedule Excel file from Blob Storage
+    Content of filename through the local cache, which only downloads it again when it changed.
+    gzip-compressed artifacts are decompressed transparently.
+    A cached copy with etag, the ETag the manifest lists, is used without asking the store.
+    With the sha256 the manifest lists, the stored bytes are checked against it.
     '''
-    # Create a BlobServiceClient object
-    blob_service_client = BlobServiceClient.from_connection_string(CONNECTION_STRING)
+    with stage("download", artifact=filename) as record:
+        data = get_artifact_cache().read(filename, etag)
+        record.bytes = len(data)
+    if sha256 is not None and hashlib.sha256(data).hexdigest() != sha256:
+        raise ArtifactMismatchError(f"{filename} in the store does not match the manifest")
+    # Compressed artifacts are cached as stored and decompressed on every read
+    return decompress(data)
 
-    # Get a client to interact with the container and the specific blob
-    blob_client = blob_service_client.get_blob_client(container=CONTAINER_NAME, blob=filename)
 
-    # Download the blob as a string
-    # blob_data = blob_client.download_blob().readall()
-    blob_data = blob_client.download_blob().read()
+def get_manifest() -> dict:
+    '''
+    The manifest, None before anything was published
+    '''
+    try:
+        return json.loads(download_artifact(MANIFEST))
+    except FileNotFoundError:
+        return None
+
+
+def get_stop_ids() -> dict:
+    '''
+    Canonical stop name -> stop_id of the published stop registry, empty before the first workbook
+    '''
+    try:
+        registry = pd.read_csv(BytesIO(download_artifact(STOP_REGISTRY)))
+    except FileNotFoundError:
+        return {}
+    return dict(zip(registry['stop_name'], registry['stop_id'].astype(int)))
+
+
+def publish_stop_registry(stop_ids: dict):
+    '''
+    Publish a stop registry built outside a workbook upload, e.g. by a batch run, and
+    point the manifest at it
+    '''
+    tables = {STOP_REGISTRY: StopRegistry(known_ids=stop_ids).registry_table()}
+    staged = {export_path: upload.result() for export_path, upload in stage_artifacts(tables, STOP_REGISTRY).items()}
+    for export_path, artifact in staged.items():
+        commit_artifact(export_path, artifact)
+    manifest = get_manifest()
+    if manifest is not None:
+        manifest['artifacts'].update({export_path: {key: artifact[key] for key in ('sha256', 'bytes', 'etag')}
+                                      for export_path, artifact in staged.items()})
+        get_store().upload(MANIFEST, [json.dumps(manifest, indent=2).encode('utf-8')], "application/json")
+    print(f"Published {STOP_REGISTRY} with {len(stop_ids)} stops")
+
+
+def get_xlsx_file(filename: str = None):
+    '''
+    Load the bus schedule Excel file from the artifact store, the current one by default
+    '''
+    manifest = get_manifest()
+    if filename is None:
+        if manifest is None:
+            raise FileNotFoundError("No workbook has been published yet")
+        filename = manifest['workbook']['name']
+    entry = manifest['workbook'] if manifest and manifest['workbook']['name'] == filename else {}
 
     # Read the Excel file into a pandas ExcelFile object
-    excel_file = pd.ExcelFile(BytesIO(blob_data))
-    
-    blob_list = blob_service_client.get_container_client(CONTAINER_NAME).list_blobs()
-    # Iterate through the blobs to find the xlsx file
-    for blob in blob_list:
-        if blob.name.endswith('.xlsx'):
-            xlsx_file_name = blob.name
-            break  # Stop the loop once the xlsx file is found
-        
-    return excel_file, xlsx_file_name
+    excel_file = open_workbook(BytesIO(download_artifact(filename, entry.get('etag'), entry.get('sha256'))))
+    return excel_file, filename
 
 
 def get_csv_file(filename: str = "bus_trips.csv"):
     '''
-    Get bus_trips.csv or bus_schedule.csv or StartingTime.csv file from Blob Storage
+    Get bus_trips.csv or bus_schedule.csv or StartingTime.csv file from the artifact store
     '''
-    
-    # Create a BlobServiceClient object
-    blob_service_client = BlobServiceClient.from_connection_string(CONNECTION_STRING)
+    df = pd.read_csv(BytesIO(download_artifact(filename)))
+    return df
 
-    # Get a client to interact with the container and the specific blob
-    blob_client = blob_service_client.get_blob_client(container=CONTAINER_NAME, blob=filename)
 
-    container_client = blob_service_client.get_container_client(CONTAINER_NAME)
+def get_parquet_file(filename: str = "bus_trips.parquet"):
+    '''
+    Get the typed table of a generated file from the artifact store
+    '''
+    return read_parquet(download_artifact(filename))
 
-    blob_client = container_client.get_blob_client(filename)
 
-    df = pd.read_csv(blob_client.download_blob())
-    return df
+def get_published_parquet_files(filenames: tuple) -> dict:
+    '''
+    Typed tables of the published set. The manifest is resolved once and unchanged
+    tables are read from the local cache without a request each. Every table is checked
+    against the manifest, so the tables always belong to the same set.
+    '''
+    try:
+        return read_published_parquet_files(get_manifest(), filenames)
+    except ArtifactMismatchError:
+        # A newer set was published while reading, read that one instead
+        return read_published_parquet_files(get_manifest(), filenames)
 
 
-def generate_starting_time(bus_calender_file: pd.ExcelFile, 
-                           export_path: str = "StartingTime.csv") -> None:
-    # Get the sheet names
-    # sheet_names = bus_calender_file.sheet_names
-    
-    sheet_names = ('Hai Ba Trung', 'Cau Giay', 'Tay Ho', 'Ha Dong', 'Ecopark')
-    dfs = {}
-    for sheet_name in sheet_names:
-        dfs[sheet_name] = pd.read_excel(bus_calender_file, sheet_name=sheet_name)
+def read_published_parquet_files(manifest: dict, filenames: tuple) -> dict:
+    artifacts = (manifest or {}).get('artifacts', {})
+    return {filename: read_parquet(download_artifact(filename, artifacts.get(filename, {}).get('etag'),
+                                                     artifacts.get(filename, {}).get('sha256')))
+            for filename in filenames}
 
-    # Print the names of the loaded sheets
-    print("Loaded sheets:", list(dfs.keys()))
-    
-    # Generate StartingTime.csv file
-    df = pd.DataFrame(columns=['route_name', 
-                               'pickup_point', 
-                               'dropoff_point', 
-                               'date', 
-                               'slot1', 
-                               'slot2', 
-                               'slot3', 
-                               'slot4', 
-                               'slot5', 
-                               'slot6'])
-
-    # Iterate over the dictionary of dataframes
-    for route_name, route_df in dfs.items():
-        # Iterate over the rows of the dataframe
-        for i in range(len(route_df)):
-            if i < 3:
-                continue
-            
-            pickup_point = route_df.iloc[i][0]
-            if "buv" in pickup_point.lower():
-                pickup_point = "BUV Campus"
-            elif "aeon" in pickup_point.lower():
-                pickup_point = "AEON Mall Long Bien"
-            elif "le dai hanh" in pickup_point.lower():
-                pickup_point = "51 Le Dai Hanh"
-            else:
-                pickup_point = pickup_point.title()
-            for j in range(i + 1, len(route_df)):
-                # Get the dropoff points
-                dropoff_point = route_df.iloc[j][0]
-                if "buv" in dropoff_point.lower():
-                    dropoff_point = "BUV Campus"
-                elif "aeon" in dropoff_point.lower():
-                    dropoff_point = "AEON Mall Long Bien"
-                elif "le dai hanh" in dropoff_point.lower():
-                    dropoff_point = "51 Le Dai Hanh"
-                else:
-                    dropoff_point = dropoff_point.title()
-                
-                # Define the common columns
-                new_row_data = {
-                    'route_name': route_name.title(),
-                    'pickup_point': pickup_point,
-                    'dropoff_point': dropoff_point,
-                    'date': None
-                }
-                
-                # Iterate over the slots
-                for k in range(1, 6):
-                    # Get the slot value
-                    slot = route_df.iloc[i][k].strftime("%H:%M")
 
-                    # Add all slot columns to the dictionary
-                    new_row_data[f'slot{k}'] = slot  # Assign slot value to the correct slot column
+def get_stop_time_grids() -> list:
+    '''
+    Stop-time grids of the published workbook, read back from route_stop_times, for iter_segments
+    '''
+    table = get_published_parquet_files(("route_stop_times.parquet",))["route_stop_times.parquet"]
+    return grids_from_table(to_pandas(table))
 
-                # Create a new DataFrame with the new row
-                new_row = pd.DataFrame([new_row_data])
 
-                # Concatenate the new DataFrame with the existing DataFrame
-                df = pd.concat([df, new_row], ignore_index=True)
-        
-        # Iterate over the rows of the dataframe
-        for i in range(len(route_df)):
-            if i < 3:
-                continue
-            
-            pickup_point = route_df.iloc[i][7]
-            if "buv" in pickup_point.lower():
-                pickup_point = "BUV Campus"
-            elif "aeon" in pickup_point.lower():
-                pickup_point = "AEON Mall Long Bien"
-            elif "le dai hanh" in pickup_point.lower():
-                pickup_point = "51 Le Dai Hanh"
-            else:
-                pickup_point = pickup_point.title()
-            for j in range(i + 1, len(route_df)):
-                # Get the dropoff points
-                dropoff_point = route_df.iloc[j][7]
-                if "buv" in dropoff_point.lower():
-                    dropoff_point = "BUV Campus"
-                elif "aeon" in dropoff_point.lower():
-                    dropoff_point = "AEON Mall Long Bien"
-                elif "le dai hanh" in dropoff_point.lower():
-                    dropoff_point = "51 Le Dai Hanh"
-                else:
-                    dropoff_point = dropoff_point.title()
-                
-                # Define the common columns
-                new_row_data = {
-                    'route_name': route_name.title(),
-                    'pickup_point': pickup_point,
-                    'dropoff_point': dropoff_point,
-                    'date': None
-                }
-                
-                # Iterate over the slots
-                for k in range(1, 6):
-                    # Get the slot value
-                    slot = route_df.iloc[i][k + 7].strftime("%H:%M")
+def get_processed_workbook() -> dict:
+    '''
+    Manifest entry of the workbook the published artifacts were generated from, None before the first one
+    '''
+    manifest = get_manifest()
+    return None if manifest is None else manifest['workbook']
 
-                    # Add all slot columns to the dictionary
-                    new_row_data[f'slot{k}'] = slot  # Assign slot value to the correct slot column
 
-                # Create a new DataFrame with the new row
-                new_row = pd.DataFrame([new_row_data])
+def generate_route_stop_times(workbook: BusWorkbook) -> pd.DataFrame:
+    # The segment model: one stop-time grid per route direction, segments are derived from it
+    return grids_table(stop_time_grids(workbook))
 
-                # Concatenate the new DataFrame with the existing DataFrame
-                df = pd.concat([df, new_row], ignore_index=True)
-    
-    
-    df.to_csv(export_path, index=False)
-    blob_block = ContainerClient.from_connection_string(
-        conn_str=CONNECTION_STRING,
-        container_name=CONTAINER_NAME
-        )
-    output = StringIO()
-    output = df.to_csv(index=False, encoding='utf-8')
-    blob_block.upload_blob(export_path, output, overwrite=True, encoding='utf-8')
-    print(f"{export_path} file has been generated and uploaded to Blob Storage {CONTAINER_NAME}.")
-    
 
-def generate_bus_trips(bus_calender_file: pd.ExcelFile, 
-                        export_path: str = "bus_trips.csv"):
+def generate_starting_time(workbook: BusWorkbook, export_path: str = None) -> pd.DataFrame:
+    # Generate StartingTime.csv file, the artifact writer uploads it. A local copy only with export_path.
+    # Pairs come straight from the parsed grids, route_stop_times.csv is only read back by consumers.
+    df = starting_time_table(stop_time_grids(workbook))
     
-    # sheet_names = bus_calender_file.sheet_names
-    sheet_names = ('Hai Ba Trung', 'Cau Giay', 'Tay Ho', 'Ha Dong', 'Ecopark')
+    if export_path is not None:
+        df.to_csv(export_path, index=False)
+    return df
     
-    dfs = {}
-    for sheet_name in sheet_names:
-        dfs[sheet_name] = pd.read_excel(bus_calender_file, sheet_name=sheet_name)
-    print("Loaded sheets:", list(dfs.keys()))
 
+def generate_bus_trips(workbook: BusWorkbook) -> pd.DataFrame:
     df = pd.DataFrame(columns=['trip_id', 'route', 'departure_district', 'arrival', 'departure_time', 'arrival_time'])
 
     new_row_data_list = []
     trip_id = 1
-    for route_name, route_df in dfs.items():
-        # Interate over the columns of route_df
-        for col_idx in range(1, 6):
+    for route_name, route in workbook.routes.items():
+        # Interate over the outbound slots
+        for col_idx in range(route.outbound_times.shape[1]):
             formatted_route_name = route_name.title() + " to BUV Campus"
             departure_district = route_name.title()
             arrival = "BUV Campus"
-            departure_time = route_df.iloc[3][col_idx].strftime("%H:%M")
-            arrival_time = route_df.iloc[-1][col_idx].strftime("%H:%M")
+            departure_time = route.outbound_times[0][col_idx].strftime("%H:%M")
+            arrival_time = route.outbound_times[-1][col_idx].strftime("%H:%M")
             new_row_data = {
                             'trip_id': trip_id,
                             'route': formatted_route_name,
@@ -354,14 +545,14 @@ def generate_bus_trips(bus_calender_file: pd.ExcelFile,
             
         new_data = pd.DataFrame(new_row_data_list)
 
-    for route_name, route_df in dfs.items():
-        # Interate over the columns of route_df
-        for col_idx in range(1, 7):
+    for route_name, route in workbook.routes.items():
+        # Interate over the return slots
+        for col_idx in range(route.return_times.shape[1]):
             formatted_route_name = "BUV Campus to " + route_name.title()
             departure_district = "BUV Campus"
             arrival = route_name.title()
-            departure_time = route_df.iloc[3][col_idx + 7].strftime("%H:%M")
-            arrival_time = route_df.iloc[-1][col_idx + 7].strftime("%H:%M")
+            departure_time = route.return_times[0][col_idx].strftime("%H:%M")
+            arrival_time = route.return_times[-1][col_idx].strftime("%H:%M")
             new_row_data = {
                             'trip_id': trip_id,
                             'route': formatted_route_name,
@@ -377,22 +568,12 @@ def generate_bus_trips(bus_calender_file: pd.ExcelFile,
         
     df = pd.concat([df, new_data], ignore_index=True)
 
-    # df.to_csv(export_path, index=False)
-    blob_block = ContainerClient.from_connection_string(
-        conn_str=CONNECTION_STRING,
-        container_name=CONTAINER_NAME
-        )
-    output = StringIO()
-    output = df.to_csv(index=False, encoding='utf-8')
-    blob_block.upload_blob(export_path, output, overwrite=True, encoding='utf-8')
-    print(f"{export_path} file has been generated and uploaded to Blob Storage {CONTAINER_NAME}.")
+    return df
 
 
-def generate_bus_schedule(bus_calender_file: pd.ExcelFile,
-                          export_path: str = "bus_schedule.csv"):
-    bus_trips = get_csv_file("bus_trips.csv")
+def generate_bus_schedule(workbook: BusWorkbook, bus_trips: pd.DataFrame) -> pd.DataFrame:
     
-    df = pd.DataFrame(columns=['trip_id', 'stop_sequence', 'stop_name', 'stop_time'])
+    df = pd.DataFrame(columns=['trip_id', 'stop_sequence', 'stop_id', 'stop_name', 'stop_time'])
 
     # Iterate over the trip_id
     for trip_id in bus_trips['trip_id']:
@@ -403,30 +584,21 @@ def generate_bus_schedule(bus_calender_file: pd.ExcelFile,
         departure_time = bus_trips[bus_trips['trip_id'] == trip_id]['departure_time'].values[0]
         
         if departure_district != "BUV Campus":
-            sheet_name = departure_district
-            stops = pd.read_excel(bus_calender_file, sheet_name=sheet_name)        
-            times_str = [time.strftime("%H:%M") for time in stops.iloc[3][1:6].values]
+            route = workbook.routes[departure_district]
+            times_str = [time.strftime("%H:%M") for time in route.outbound_times[0]]
+            stop_ids = workbook.stops.stop_ids(route.outbound_stops)
+            stop_names = workbook.stops.stop_names(route.outbound_stops)
             
             new_row_data_list = []
-            for i in range(len(stops)):
-                if i < 3:
-                    continue
-                col_idx = times_str.index(departure_time) + 1
-                stop_time = stops.iloc[i][col_idx].strftime("%H:%M")
+            for i in range(len(route.outbound_stops)):
+                col_idx = times_str.index(departure_time)
+                stop_time = route.outbound_times[i][col_idx].strftime("%H:%M")
                 
-                stop_name = stops.iloc[i][0]
-                if "buv" in stop_name.lower():
-                    stop_name = "BUV Campus"
-                elif "aeon" in stop_name.lower():
-                    stop_name = "AEON Mall Long Bien"
-                elif "le dai hanh" in stop_name.lower():
-                    stop_name = "51 Le Dai Hanh"
-                else:
-                    stop_name = stop_name.title()
                 new_row_data = {
                                 'trip_id': trip_id,
                                 'stop_sequence': stop_sequence,
-                                'stop_name': stop_name,
+                                'stop_id': stop_ids[i],
+                                'stop_name': stop_names[i],
                                 'stop_time': stop_time,
                             }
                 new_row_data_list.append(new_row_data)
@@ -434,30 +606,21 @@ def generate_bus_schedule(bus_calender_file: pd.ExcelFile,
             new_data = pd.DataFrame(new_row_data_list)
         else:
             arrival = bus_trips[bus_trips['trip_id'] == trip_id]['arrival'].values[0]
-            sheet_name = arrival
-            stops = pd.read_excel(bus_calender_file, sheet_name=sheet_name)
+            route = workbook.routes[arrival]
             
-            times_str = [time.strftime("%H:%M") for time in stops.iloc[3][8:14].values]
+            times_str = [time.strftime("%H:%M") for time in route.return_times[0]]
+            stop_ids = workbook.stops.stop_ids(route.return_stops)
+            stop_names = workbook.stops.stop_names(route.return_stops)
             new_row_data_list = []
-            for i in range(len(stops)):
-                if i < 3:
-                    continue
-                col_idx = times_str.index(departure_time) + 8
-                stop_time = stops.iloc[i][col_idx].strftime("%H:%M")
+            for i in range(len(route.return_stops)):
+                col_idx = times_str.index(departure_time)
+                stop_time = route.return_times[i][col_idx].strftime("%H:%M")
                 
-                stop_name = stops.iloc[i][7]
-                if "buv" in stop_name.lower():
-                    stop_name = "BUV Campus"
-                elif "aeon" in stop_name.lower():
-                    stop_name = "AEON Mall Long Bien"
-                elif "le dai hanh" in stop_name.lower():
-                    stop_name = "51 Le Dai Hanh"
-                else:
-                    stop_name = stop_name.title()
                 new_row_data = {
                                 'trip_id': trip_id,
                                 'stop_sequence': stop_sequence,
-                                'stop_name': stop_name,
+                                'stop_id': stop_ids[i],
+                                'stop_name': stop_names[i],
                                 'stop_time': stop_time,
                             }
                 new_row_data_list.append(new_row_data)
@@ -467,19 +630,54 @@ def generate_bus_schedule(bus_calender_file: pd.ExcelFile,
         df = pd.concat([df, new_data], ignore_index=True)
         # Get the data from row 3 onwards, 
 
-    # df.to_csv(export_path, index=False)
-    blob_block = ContainerClient.from_connection_string(
-        conn_str=CONNECTION_STRING,
-        container_name=CONTAINER_NAME
-        )
-    output = StringIO()
-    output = df.to_csv(index=False, encoding='utf-8')
-    blob_block.upload_blob(export_path, output, overwrite=True, encoding='utf-8')
-    print(f"{export_path} file has been generated and uploaded to Blob Storage {CONTAINER_NAME}.")
+    return df
     
     
-def generate_bus_timetable(bus_calender_file: pd.ExcelFile,
-                           export_path: str = "bus_timetable.csv"):
+def calendar_trips(calendar: CalendarSheet, mask: np.ndarray, first_trip_id: int) -> pd.DataFrame:
+    '''
+    Active trips of one direction as (calendar_row, trip_id), expanded from the calendar grid.
+    Rows of the same day are numbered in order from first_trip_id, one trip_id per slot,
+    and the route sheets without calendar rows (Ecopark) follow right after them using
+    the flags of the shared route (HBT) that day.
+    '''
+    n_rows, n_slots = mask.shape
+    days = calendar.days
+    if n_rows == 0:
+        return pd.DataFrame({'calendar_row': np.empty(0, dtype=int), 'trip_id': np.empty(0, dtype=int)})
+
+    # Day groups are runs of consecutive rows with the same weekday
+    group_starts = np.flatnonzero(np.r_[True, days[1:] != days[:-1]])
+    group_ends = np.r_[group_starts[1:], n_rows] - 1
+    group = np.repeat(np.arange(len(group_starts)), group_ends - group_starts + 1)
+    position = np.arange(n_rows) - group_starts[group]
+
+    # Ecopark has no calendar rows of its own, it copies the shared route's row of its day
+    hbt_rows = np.flatnonzero(calendar.routes == calendar.shared_route)
+    ecopark_idx = np.searchsorted(hbt_rows, group_starts)
+    if (ecopark_idx >= len(hbt_rows)).any() or (hbt_rows[np.minimum(ecopark_idx, len(hbt_rows) - 1)] > group_ends).any():
+        raise ValueError(f"Every day in calendar sheet '{calendar.name}' needs a {calendar.shared_route} row")
+    ecopark_rows = hbt_rows[ecopark_idx]
+    ecopark_position = group_ends - group_starts + 1
+
+    # Interleave one Ecopark pseudo-row after the last row of each day
+    row_order = np.arange(n_rows) + group
+    ecopark_order = group_ends + np.arange(len(group_starts)) + 1
+    source_rows = np.empty(n_rows + len(group_starts), dtype=int)
+    source_rows[row_order] = np.arange(n_rows)
+    source_rows[ecopark_order] = group_ends
+    flags = np.empty((len(source_rows), n_slots), dtype=bool)
+    flags[row_order] = mask
+    flags[ecopark_order] = mask[ecopark_rows]
+    positions = np.empty(len(source_rows), dtype=int)
+    positions[row_order] = position
+    positions[ecopark_order] = ecopark_position
+
+    trip_ids = first_trip_id + positions[:, None] * n_slots + np.arange(n_slots)
+    return pd.DataFrame({'calendar_row': np.repeat(source_rows, n_slots)[flags.ravel()],
+                         'trip_id': trip_ids[flags]})
+
+
+def generate_bus_timetable(workbook: BusWorkbook) -> pd.DataFrame:
     
     day_abbv_to_full = {
         'Mon': 'Monday',
@@ -491,113 +689,44 @@ def generate_bus_timetable(bus_calender_file: pd.ExcelFile,
         'Sun': 'Sunday'
     }
 
+    calendar = workbook.calendar
+    # Return trips are numbered after every outbound trip, the same way generate_bus_trips does
+    first_return_trip_id = 1 + len(workbook.routes) * calendar.outbound_mask.shape[1]
+    trips = pd.concat([calendar_trips(calendar, calendar.outbound_mask, 1),
+                       calendar_trips(calendar, calendar.return_mask, first_return_trip_id)],
+                      ignore_index=True)
+
+    # Format each calendar row once, then gather by row index
+    rows = trips['calendar_row'].to_numpy()
+    full_days = np.array([day_abbv_to_full[day] for day in calendar.days], dtype=object)
+    formatted_dates = np.asarray(calendar.dates.strftime("%m/%d/%Y"), dtype=object)
+    df = pd.DataFrame({'day_of_week': full_days[rows],
+                       'trip_id': trips['trip_id'].to_numpy(),
+                       'date': formatted_dates[rows]})
+    return df
 
-    route_names = ('Hai Ba Trung', 'Cau Giay', 'Tay Ho', 'Ha Dong', 'Ecopark')
-
-    calendar = pd.read_excel(bus_calender_file, sheet_name=bus_calender_file.sheet_names[-1])
-    
-    df = pd.DataFrame(columns=['day_of_week', 'trip_id', 'date'])
 
+def generate_stops(workbook: BusWorkbook) -> pd.DataFrame:
+    # Dimension table of the stops bus_schedule refers to by stop_id
+    return workbook.stops.stops_table()
 
-    trip_id = 1
-    initial_trip_id = trip_id
-    for i in range(len(calendar)):
-        if i < 9:
-            continue
-        
-        day_of_week = calendar.iloc[i][1]
-        if i + 1 < len(calendar):
-            next_day_of_week = calendar.iloc[i + 1][1]
-        else:
-            next_day_of_week = " "
-            
-        for j in range(3, 8):
-            has_trip = int(calendar.iloc[i][j])
-            formatted_date = pd.to_datetime(calendar.iloc[i][0]).strftime("%m/%d/%Y")
-            # formatted_date = pd.to_datetime(calendar.iloc[i][0]).strftime("%d/%m/%Y")
-            if has_trip == 1:
-                new_row_data = {
-                    'day_of_week': day_abbv_to_full[day_of_week],
-                    'trip_id': trip_id,
-                    'date': formatted_date,
-                }
-                new_row = pd.DataFrame([new_row_data])
-                df = pd.concat([df, new_row], ignore_index=True)
-            
-            trip_id += 1
-        
-        if next_day_of_week != day_of_week:
-            ecopark_departure_mask = calendar[(calendar.iloc[:, 1] == day_of_week) & (calendar.iloc[:, 2] == 'HBT')].iloc[:, 3:8].values[0]
-            for j in range(3, 8):
-                formatted_date = pd.to_datetime(calendar.iloc[i][0]).strftime("%m/%d/%Y")
-                # formatted_date = pd.to_datetime(calendar.iloc[i][0]).strftime("%d/%m/%Y")
-                if ecopark_departure_mask[j - 3] == 1:
-                    new_row_data = {
-                        'day_of_week': day_abbv_to_full[day_of_week],
-                        'trip_id': trip_id,
-                        'date': formatted_date,
-                    }
-                    new_row = pd.DataFrame([new_row_data])
-                    df = pd.concat([df, new_row], ignore_index=True)
-                    
-                trip_id += 1
-            
-            trip_id = initial_trip_id
-
-    trip_id = df['trip_id'].values[-1] + 1
-    initial_trip_id = trip_id
-    for i in range(len(calendar)):
-        if i < 9:
-            continue
-        
-        day_of_week = calendar.iloc[i][1]
-        if i + 1 < len(calendar):
-            next_day_of_week = calendar.iloc[i + 1][1]
-        else:
-            next_day_of_week = " "
-            
-        for j in range(8, 14):
-            has_trip = int(calendar.iloc[i][j])
-            formatted_date = pd.to_datetime(calendar.iloc[i][0]).strftime("%m/%d/%Y")
-            # formatted_date = pd.to_datetime(calendar.iloc[i][0]).strftime("%d/%m/%Y")
-            if has_trip == 1:
-                new_row_data = {
-                    'day_of_week': day_abbv_to_full[day_of_week],
-                    'trip_id': trip_id,
-                    'date': formatted_date,
-                }
-                new_row = pd.DataFrame([new_row_data])
-                df = pd.concat([df, new_row], ignore_index=True)
-            
-            trip_id += 1
-        
-        if next_day_of_week != day_of_week:
-            ecopark_arrival_mask = calendar[(calendar.iloc[:, 1] == day_of_week) & (calendar.iloc[:, 2] == 'HBT')].iloc[:, 8:14].values[0]
-            for j in range(8, 14):
-                formatted_date = pd.to_datetime(calendar.iloc[i][0]).strftime("%m/%d/%Y")
-                # formatted_date = pd.to_datetime(calendar.iloc[i][0]).strftime("%d/%m/%Y")
-                if ecopark_arrival_mask[j - 8] == 1:
-                    new_row_data = {
-                        'day_of_week': day_abbv_to_full[day_of_week],
-                        'trip_id': trip_id,
-                        'date': formatted_date,
-                    }
-                    new_row = pd.DataFrame([new_row_data])
-                    df = pd.concat([df, new_row], ignore_index=True)
-                    
-                trip_id += 1
-            # trip_id = 1
-            trip_id = initial_trip_id
-                
-    # df.to_csv(export_path, index=False)
-    blob_block = ContainerClient.from_connection_string(
-        conn_str=CONNECTION_STRING,
-        container_name=CONTAINER_NAME
-        )
-    output = StringIO()
-    output = df.to_csv(index=False, encoding='utf-8')
-    blob_block.upload_blob(export_path, output, overwrite=True, encoding='utf-8')
-    print(f"{export_path} file has been generated and uploaded to Blob Storage {CONTAINER_NAME}.")
 
+def generate_stop_registry(workbook: BusWorkbook) -> pd.DataFrame:
+    # Published with the other artifacts, the next workbook is parsed against it
+    return workbook.stops.registry_table()
 
 
+# Stage graph of the pipeline: artifact -> (generator, artifacts it consumes).
+# Stages are listed in dependency order and receive their inputs in memory.
+PIPELINE_STAGES = {
+    "stops.csv": (generate_stops, ()),
+    STOP_REGISTRY: (generate_stop_registry, ()),
+    "route_stop_times.csv": (generate_route_stop_times, ()),
+    "StartingTime.csv": (generate_starting_time, ()),
+    "bus_trips.csv": (generate_bus_trips, ()),
+    "bus_schedule.csv": (generate_bus_schedule, ("bus_trips.csv",)),
+    "bus_timetable.csv": (generate_bus_timetable, ()),
+}
+# StartingTime.csv grows with stops squared, EXPORT_STARTING_TIME=0 leaves it to iter_segments
+if os.getenv("EXPORT_STARTING_TIME", "1") == "0":
+    del PIPELINE_STAGES["StartingTime.csv"]
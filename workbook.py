@@ -0,0 +1,218 @@
+import os
+from dataclasses import InitVar, dataclass, field
+from datetime import datetime, time, timedelta
+
+import numpy as np
+import pandas as pd
+
+from layout import (BUS_WORKBOOK, DAY_ABBREVIATIONS, FIRST_DATA_ROW, CompiledLayout, WorkbookLayout,
+                    WorkbookLayoutError, cell_name, compile_layout)
+from stops import StopRegistry
+from telemetry import stage
+
+
+ROUTE_SHEETS = BUS_WORKBOOK.route_sheets
+
+# calamine parses the workbooks several times faster than openpyxl with the same cell values
+EXCEL_ENGINES = ('calamine', 'openpyxl')
+EXCEL_ENGINE = os.getenv("EXCEL_ENGINE", "calamine")
+
+
+@dataclass
+class RouteSheet:
+    '''
+    Stops and departure grids of one route sheet.
+    Time grids hold datetime.time cells, one row per stop and one column per slot.
+    '''
+    name: str
+    outbound_stops: np.ndarray
+    outbound_times: np.ndarray
+    return_stops: np.ndarray
+    return_times: np.ndarray
+
+
+@dataclass
+class CalendarSheet:
+    '''
+    Weekly calendar: one row per (date, route) with the active slots of each direction.
+    '''
+    name: str
+    dates: pd.DatetimeIndex
+    days: np.ndarray
+    routes: np.ndarray
+    outbound_mask: np.ndarray
+    return_mask: np.ndarray
+    # Route code whose flags the route sheets without calendar rows follow
+    shared_route: str
+
+
+@dataclass
+class BusWorkbook:
+    '''
+    Parsed workbook. Its stops are interned once, outbound then return stops of each route.
+    '''
+    routes: dict
+    calendar: CalendarSheet
+    # Canonical stop name -> stop_id of the stops earlier workbooks registered
+    known_stop_ids: InitVar[dict] = None
+    stops: StopRegistry = field(init=False, repr=False)
+
+    def __post_init__(self, known_stop_ids: dict):
+        self.stops = StopRegistry(known_ids=known_stop_ids)
+        for route in self.routes.values():
+            self.stops.stop_ids(route.outbound_stops)
+            self.stops.stop_ids(route.return_stops)
+
+
+def open_workbook(source, engine: str = None) -> pd.ExcelFile:
+    '''
+    Open a schedule workbook with the configured engine, falling back to openpyxl
+    when python-calamine is not installed
+    '''
+    engine = engine or EXCEL_ENGINE
+    if engine not in EXCEL_ENGINES:
+        raise ValueError(f"Unsupported Excel engine {engine!r}, expected one of {EXCEL_ENGINES}")
+    if engine == 'calamine':
+        try:
+            import python_calamine  # noqa: F401
+        except ImportError:
+            engine = 'openpyxl'
+    return pd.ExcelFile(source, engine=engine)
+
+
+def to_time(value) -> time:
+    '''
+    Time of day of a slot cell. Engines differ in how they hand back time-formatted
+    cells (time, datetime, timedelta or a fraction of a day), text cells are parsed.
+    '''
+    if isinstance(value, datetime):
+        return value.time()
+    if isinstance(value, time):
+        return value
+    if isinstance(value, timedelta):
+        return (datetime.min + value).time()
+    if isinstance(value, (int, float, np.integer, np.floating)) and not isinstance(value, bool) and not pd.isna(value):
+        return (datetime.min + timedelta(seconds=round(float(value) * 86400) % 86400)).time()
+    if isinstance(value, str):
+        return pd.to_datetime(value.strip(), format="mixed").time()
+    raise ValueError(f"Not a time cell: {value!r}")
+
+
+def parse_times(cells: np.ndarray, problems: list, sheet: str, rows: np.ndarray, columns: np.ndarray) -> np.ndarray:
+    '''
+    Times of a block of slot cells, recording every cell that is not a time in problems
+    '''
+    times = np.empty(cells.shape, dtype=object)
+    for (i, j), value in np.ndenumerate(cells):
+        try:
+            times[i, j] = to_time(value)
+        except ValueError:
+            problems.append(f"Sheet '{sheet}' cell {cell_name(rows[i], columns[j])}: {value!r} is not a time")
+    return times
+
+
+def parse_stops(cells: np.ndarray, problems: list, sheet: str, rows: np.ndarray, column: int) -> np.ndarray:
+    for i in np.flatnonzero(pd.isna(cells)):
+        problems.append(f"Sheet '{sheet}' cell {cell_name(rows[i], column)}: missing stop name")
+    return cells
+
+
+def parse_route_sheet(name: str, route_df: pd.DataFrame, problems: list,
+                      plan: CompiledLayout = None) -> RouteSheet:
+    plan = plan or compile_layout()
+    layout = plan.layout.route_sheet
+    if route_df.shape[1] < plan.route_width or len(route_df) < layout.header_rows + 2:
+        problems.append(f"Sheet '{name}' is {route_df.shape[0]}x{route_df.shape[1]}, a route sheet needs "
+                        f"at least {layout.header_rows + 2} rows and {plan.route_width} columns")
+        return None
+    # One gather for every column the parser reads, then plain slices of it
+    rows = np.arange(layout.header_rows, len(route_df))
+    cells = route_df.to_numpy(dtype=object)[layout.header_rows:, plan.route_columns]
+    columns = plan.route_columns
+    outbound = slice(1, 1 + plan.outbound_slots)
+    return_stop = 1 + plan.outbound_slots
+    returns = slice(return_stop + 1, return_stop + 1 + plan.return_slots)
+    return RouteSheet(name=name,
+                      outbound_stops=parse_stops(cells[:, 0], problems, name, rows, columns[0]),
+                      outbound_times=parse_times(cells[:, outbound], problems, name, rows, columns[outbound]),
+                      return_stops=parse_stops(cells[:, return_stop], problems, name, rows, columns[return_stop]),
+                      return_times=parse_times(cells[:, returns], problems, name, rows, columns[returns]))
+
+
+def parse_calendar_sheet(name: str, calendar_df: pd.DataFrame, problems: list,
+                         plan: CompiledLayout = None) -> CalendarSheet:
+    plan = plan or compile_layout()
+    layout = plan.layout.calendar
+    if calendar_df.shape[1] < plan.calendar_width or len(calendar_df) <= layout.header_rows:
+        problems.append(f"Calendar sheet '{name}' is {calendar_df.shape[0]}x{calendar_df.shape[1]}, it needs "
+                        f"at least {layout.header_rows + 1} rows and {plan.calendar_width} columns")
+        return None
+    rows = np.arange(layout.header_rows, len(calendar_df))
+    cells = calendar_df.to_numpy(dtype=object)[layout.header_rows:, plan.calendar_columns]
+    columns = plan.calendar_columns
+
+    dates = pd.to_datetime(pd.Series(cells[:, 0]), errors='coerce')
+    for i in np.flatnonzero(dates.isna()):
+        problems.append(f"Calendar sheet '{name}' cell {cell_name(rows[i], columns[0])}: {cells[i, 0]!r} is not a date")
+    days = cells[:, 1]
+    for i in np.flatnonzero(~np.isin(days, DAY_ABBREVIATIONS)):
+        problems.append(f"Calendar sheet '{name}' cell {cell_name(rows[i], columns[1])}: {days[i]!r} is not a day")
+
+    # Trip ids are numbered by position within a day, so every day lists every route code in order
+    routes = cells[:, 2]
+    group_starts = np.flatnonzero(np.r_[True, days[1:] != days[:-1]])
+    for start, end in zip(group_starts, np.r_[group_starts[1:], len(days)]):
+        if tuple(routes[start:end]) != layout.route_codes:
+            problems.append(f"Calendar sheet '{name}' rows {rows[start] + FIRST_DATA_ROW}-{rows[end - 1] + FIRST_DATA_ROW}: "
+                            f"routes {list(routes[start:end])}, expected {list(layout.route_codes)}")
+
+    flags = pd.DataFrame(cells[:, 3:]).apply(pd.to_numeric, errors='coerce').to_numpy()
+    for i, j in zip(*np.nonzero(~np.isin(flags, (0, 1)))):
+        problems.append(f"Calendar sheet '{name}' cell {cell_name(rows[i], columns[3 + j])}: "
+                        f"{cells[i, 3 + j]!r} is not a 0/1 flag")
+    return CalendarSheet(name=name,
+                         dates=pd.DatetimeIndex(dates),
+                         days=days,
+                         routes=routes,
+                         outbound_mask=flags[:, :plan.outbound_slots] == 1,
+                         return_mask=flags[:, plan.outbound_slots:] == 1,
+                         shared_route=layout.shared_route)
+
+
+def parse_workbook(bus_calender_file: pd.ExcelFile, layout: WorkbookLayout = BUS_WORKBOOK,
+                   known_stop_ids: dict = None) -> BusWorkbook:
+    '''
+    Read every route sheet and the calendar sheet exactly once, checking them against the layout.
+    Raises WorkbookLayoutError listing every problem before anything is generated from the workbook.
+    Stops keep the ids in known_stop_ids, new stops are numbered after them.
+    '''
+    plan = compile_layout(layout)
+    sheet_names = bus_calender_file.sheet_names
+    missing = [name for name in layout.route_sheets if name not in sheet_names]
+    calendar_name = plan.calendar_name(sheet_names)
+    if missing:
+        raise WorkbookLayoutError([f"Missing route sheet '{name}'" for name in missing])
+    if calendar_name in layout.route_sheets:
+        raise WorkbookLayoutError([f"Sheet '{calendar_name}' should be the calendar, but it is a route sheet"])
+
+    with stage("read sheets") as record:
+        sheets = pd.read_excel(bus_calender_file, sheet_name=list(layout.route_sheets) + [calendar_name])
+        record.rows = sum(len(sheet) for sheet in sheets.values())
+    print("Loaded sheets:", list(sheets.keys()))
+
+    problems = []
+    routes = {}
+    for name in layout.route_sheets:
+        with stage("parse sheet", sheet=name) as record:
+            routes[name] = parse_route_sheet(name, sheets[name], problems, plan)
+            record.rows = len(sheets[name])
+    with stage("parse sheet", sheet=calendar_name) as record:
+        calendar = parse_calendar_sheet(calendar_name, sheets[calendar_name], problems, plan)
+        record.rows = len(sheets[calendar_name])
+    if problems:
+        raise WorkbookLayoutError(problems)
+
+    with stage("intern stops") as record:
+        workbook = BusWorkbook(routes=routes, calendar=calendar, known_stop_ids=known_stop_ids)
+        record.rows = len(workbook.stops.used)
+    return workbook